@@ -0,0 +1,146 @@
+
+import numpy as np
+
+import multiprocessing as mp
+import os
+import re
+import csv
+
+import evaluate_policy
+
+# checkpoints are written by CheckpointCallback(name_prefix='rl_model') in custom_cnn_lstm.py
+CHECKPOINT_PATTERN = re.compile(r'^rl_model_(\d+)_steps\.zip$')
+MAX_TOW_DELT = 6
+
+# one env and one model per worker process, built once by _init_worker
+_worker_env = None
+_worker_model = None
+
+
+def list_checkpoints(checkpoint_dir, every=1, min_steps=0, max_steps=None):
+    """
+    Finds the rl_model_<N>_steps.zip checkpoints in a folder, ordered by training steps.
+
+    :param checkpoint_dir: (str) folder the CheckpointCallback saved into
+    :param every: (int) keep only every `every`-th checkpoint (after the step range is applied)
+    :param min_steps: (int) smallest number of training steps to keep
+    :param max_steps: (int) largest number of training steps to keep. default is all
+    :return: ([(int, str)]) (steps, load_path) pairs. load_path has no '.zip', same as get_params_from_zip
+    """
+    checkpoints = []
+    for filename in os.listdir(checkpoint_dir):
+        match = CHECKPOINT_PATTERN.match(filename)
+        if match is None:
+            continue
+        steps = int(match.group(1))
+        if steps < min_steps or (max_steps is not None and steps > max_steps):
+            continue
+        checkpoints.append((steps, os.path.join(checkpoint_dir, filename[:-len('.zip')])))
+    checkpoints.sort()
+    return checkpoints[::every]
+
+
+def summarize_episodes(ep_rew, ep_len, ep_tow, values):
+    """
+    Reduces one checkpoint's evaluation to a single row of the learning-curve table.
+
+    :param ep_rew: (np.ndarray) reward per episode
+    :param ep_len: (np.ndarray) length per episode
+    :param ep_tow: (np.ndarray) num_episodes x 2 final left/right tower counts
+    :param values: (np.ndarray) critic value at every evaluated step
+    :return: (dict) reward, psychometric (P(correct) per |delta towers|) and value summaries
+    """
+    ep_rew = np.atleast_1d(ep_rew)
+    ep_tow = np.reshape(ep_tow, (-1, 2))
+    ep_towdelt = np.abs(ep_tow[:, 0] - ep_tow[:, 1])
+    row = {'n_episodes': len(ep_rew),
+           'reward_mean': np.mean(ep_rew),
+           'reward_std': np.std(ep_rew),
+           'ep_len_mean': np.mean(ep_len)}
+    for delt in np.arange(MAX_TOW_DELT + 1):
+        delt_trials = ep_towdelt == delt
+        row['n_delt%d' % delt] = int(np.sum(delt_trials))
+        row['pcorr_delt%d' % delt] = np.mean(ep_rew[delt_trials]) if np.any(delt_trials) else np.nan
+    row['value_mean'] = np.mean(values)
+    row['value_std'] = np.std(values)
+    return row
+
+
+def _init_worker(env_id, n_lstm):
+    global _worker_env, _worker_model
+    _worker_env, _worker_model = evaluate_policy.make_eval_model(env_id, n_lstm)
+
+
+def _evaluate_checkpoint(job):
+    steps, load_path, n_eval_episodes = job
+    _worker_model.load_parameters(evaluate_policy.get_params_from_zip(load_path))
+
+    values = []
+    def record_value(locals_, globals_):
+        # value of the observation the agent is about to act on, before stepping (as get_model_data records it),
+        # so the first step of every episode is included. the lstm state starts at the model's initial state
+        state = _worker_model.initial_state if locals_['state'] is None else locals_['state']
+        values.append(_worker_model.value(locals_['obs'], state=state, mask=np.atleast_1d(locals_['done'])))
+
+    ep_rew, ep_len, ep_tow = evaluate_policy.evaluate_policy_more(_worker_model, _worker_env,
+                                    n_eval_episodes=n_eval_episodes, pre_step_callback=record_value,
+                                    return_episode_rewards=True)
+    row = summarize_episodes(ep_rew, ep_len, ep_tow, np.hstack(values) if values else np.nan)
+    row['steps'] = steps
+    return row
+
+
+def _read_table(table_path):
+    if not os.path.exists(table_path):
+        return []
+    with open(table_path, 'r', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def _write_table(table_path, rows):
+    fieldnames = list(rows[0].keys())
+    fieldnames.remove('steps')
+    fieldnames = ['steps'] + fieldnames
+    rows = sorted(rows, key=lambda row: int(row['steps']))
+    with open(table_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def sweep_checkpoints(checkpoints, table_path, n_eval_episodes=100, num_workers=4,
+                      env_id='vrgym-v0', n_lstm=64):
+    """
+    Evaluates checkpoints concurrently and collects them into one learning-curve table (csv).
+    Each worker process owns one env (and so one MATLAB engine) and one model, and only
+    swaps the parameters between checkpoints. Checkpoints already in the table are skipped,
+    so an interrupted sweep can be restarted with the same arguments.
+
+    :param checkpoints: ([(int, str)]) (steps, load_path) pairs, e.g. from list_checkpoints
+    :param table_path: (str) csv file with one row per checkpoint, sorted by steps
+    :param n_eval_episodes: (int) number of episodes to evaluate each checkpoint on
+    :param num_workers: (int) number of worker processes
+    :param env_id: (str) the registered gym environment ID
+    :param n_lstm: (int) number of LSTM units of the CnnLstmPolicy the checkpoints come from
+    :return: ([dict]) all rows of the table, including the previously computed ones
+    """
+    rows = _read_table(table_path)
+    done_steps = set(int(row['steps']) for row in rows)
+    jobs = [(steps, load_path, n_eval_episodes) for (steps, load_path) in checkpoints
+            if steps not in done_steps]
+    if len(jobs) == 0:
+        return rows
+
+    with mp.Pool(processes=min(num_workers, len(jobs)), initializer=_init_worker,
+                 initargs=(env_id, n_lstm)) as pool:
+        for row in pool.imap_unordered(_evaluate_checkpoint, jobs):
+            rows.append(row)
+            _write_table(table_path, rows) # rewrite after every checkpoint so finished results survive a crash
+            print('evaluated checkpoint at {:d} steps: mean reward {:.2f}'.format(row['steps'], row['reward_mean']))
+    return _read_table(table_path)
+
+
+if __name__ == "__main__":
+    checkpoint_dir = './logs/test/checkpoints/'
+    checkpoints = list_checkpoints(checkpoint_dir, every=10)
+    sweep_checkpoints(checkpoints, checkpoint_dir + 'learning_curve.csv', n_eval_episodes=200, num_workers=4)
@@ -0,0 +1,137 @@
+import numpy as np
+from collections import deque
+
+
+# Online summaries for evaluate_policy_more(..., accumulators=[...]).
+# Each accumulator sees every step and every finished episode but only keeps running counts,
+# so summary curves over many thousands of episodes need no per-step (or per-episode) storage.
+# evaluate_policy_more calls, for each accumulator:
+#     step(reward, state, info)  after every env.step, with the LSTM state returned by model.predict
+#     end_episode(episode_reward, episode_length, tow_counts)  once the episode is done
+# and result() gives the summary at any point.
+
+
+class EpisodeAccumulator(object):
+    """
+    Base class: accumulators only need to override the hooks they use.
+    """
+    def step(self, reward, state, info):
+        pass
+
+    def end_episode(self, episode_reward, episode_length, tow_counts):
+        pass
+
+    def result(self):
+        raise NotImplementedError
+
+
+class RewardByTowerDelta(EpisodeAccumulator):
+    """
+    Fraction of rewarded episodes for each absolute tower difference |L - R|
+    (the psychometric performance curve, as in get_ep_tow_idx(ep_tow)[0]).
+
+    :param max_delt: (int) largest |L - R|; larger differences are counted in the last entry
+    """
+    def __init__(self, max_delt=6):
+        self.rewarded = np.zeros(max_delt + 1)
+        self.counts = np.zeros(max_delt + 1, dtype=int)
+
+    def end_episode(self, episode_reward, episode_length, tow_counts):
+        delt = min(int(abs(tow_counts[0] - tow_counts[1])), len(self.counts) - 1)
+        self.rewarded[delt] += np.sum(episode_reward)
+        self.counts[delt] += 1
+
+    def result(self):
+        """
+        :return: (np.ndarray, np.ndarray, np.ndarray) |L - R|, P(reward) (nan if unseen), number of episodes
+        """
+        with np.errstate(invalid='ignore'):
+            return np.arange(len(self.counts)), self.rewarded / self.counts, self.counts
+
+
+class ChoiceByTowerDiff(EpisodeAccumulator):
+    """
+    Fraction of left choices for each tower difference L - R (the psychometric choice curve).
+    The choice is read from the outcome: a rewarded episode went to the side with more towers.
+    When L == R the rewarded side is random, so those episodes are counted but give no choice.
+
+    :param max_diff: (int) largest |L - R|; larger differences are clipped to +/- max_diff
+    """
+    def __init__(self, max_diff=6):
+        self.max_diff = max_diff
+        self.left = np.zeros(2 * max_diff + 1, dtype=int)
+        self.counts = np.zeros(2 * max_diff + 1, dtype=int)
+
+    def end_episode(self, episode_reward, episode_length, tow_counts):
+        diff = int(np.clip(tow_counts[0] - tow_counts[1], -self.max_diff, self.max_diff))
+        self.counts[diff + self.max_diff] += 1
+        rewarded = np.sum(episode_reward) > 0
+        if diff != 0 and rewarded == (diff > 0):
+            self.left[diff + self.max_diff] += 1
+
+    def result(self):
+        """
+        :return: (np.ndarray, np.ndarray, np.ndarray) L - R, P(left) (nan for L == R and unseen), number of episodes
+        """
+        with np.errstate(invalid='ignore'):
+            p_left = self.left / self.counts
+        p_left[self.max_diff] = np.nan
+        return np.arange(-self.max_diff, self.max_diff + 1), p_left, self.counts
+
+
+class EpisodeLengthHist(EpisodeAccumulator):
+    """
+    Histogram of episode lengths over fixed bins.
+
+    :param bins: (np.ndarray) bin edges, as for np.histogram. lengths outside the edges are not counted
+    """
+    def __init__(self, bins=np.arange(140, 400, 5)):
+        self.bins = np.asarray(bins)
+        self.counts = np.zeros(len(self.bins) - 1, dtype=int)
+
+    def end_episode(self, episode_reward, episode_length, tow_counts):
+        bin_i = np.searchsorted(self.bins, episode_length, side='right') - 1
+        if bin_i == len(self.counts) and episode_length == self.bins[-1]: # last bin includes its right edge
+            bin_i -= 1
+        if 0 <= bin_i < len(self.counts):
+            self.counts[bin_i] += 1
+
+    def result(self):
+        """
+        :return: (np.ndarray, np.ndarray) bin edges, counts
+        """
+        return self.bins, self.counts
+
+
+class OutcomeFeatureMean(EpisodeAccumulator):
+    """
+    Running mean of the LSTM features at outcome time, separately for rewarded and unrewarded
+    episodes. The outcome step is episode_length - steps_before_end, as ep_rewidx in the figure
+    notebooks, so only the last steps_before_end states are ever held.
+
+    :param n_lstm: (int) number of LSTM units; the features are the hidden half of the LSTM state
+    :param steps_before_end: (int) number of steps from the outcome to the end of the episode
+    """
+    def __init__(self, n_lstm=64, steps_before_end=11):
+        self.n_lstm = n_lstm
+        self.recent_feats = deque(maxlen=steps_before_end)
+        self.means = np.zeros((2, n_lstm)) # unrewarded, rewarded
+        self.counts = np.zeros(2, dtype=int)
+
+    def step(self, reward, state, info):
+        self.recent_feats.append(np.squeeze(state)[self.n_lstm:])
+
+    def end_episode(self, episode_reward, episode_length, tow_counts):
+        if len(self.recent_feats) == self.recent_feats.maxlen:
+            outcome = int(np.sum(episode_reward) > 0)
+            self.counts[outcome] += 1
+            self.means[outcome] += (self.recent_feats[0] - self.means[outcome]) / self.counts[outcome]
+        self.recent_feats.clear()
+
+    def result(self):
+        """
+        :return: (np.ndarray, np.ndarray) 2 x n_lstm mean features (unrewarded, rewarded), number of episodes
+        """
+        means = self.means.copy()
+        means[self.counts == 0] = np.nan
+        return means, self.counts
@@ -19,20 +19,34 @@ import subprocess
 from stable_baselines.common.vec_env import VecEnv
 
 import os
-import zipfile
-import io
+import sys
+import importlib.util
 
-def get_params_from_zip(load_path):
-    model_file = zipfile.ZipFile(load_path + '.zip', "r")
-    parameter_bytes = model_file.read("parameters")
-    parameter_buffer = io.BytesIO(parameter_bytes)
-    parameters = dict(np.load(parameter_buffer))
-    model_file.close()
-    return parameters
+# the checkpoint loader is shared with the figure code, which imports it as utils.checkpoint_params
+# (from the figures folder). this module reuses that module object, or loads it under that name, so a
+# process using both has a single checkpoint cache. sys.path is left alone
+CHECKPOINT_PARAMS_MODULE = 'utils.checkpoint_params'
+CHECKPOINT_PARAMS_PATH = os.path.realpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'figures', 'utils', 'checkpoint_params.py'))
+
+
+def _import_checkpoint_params():
+    module = sys.modules.get(CHECKPOINT_PARAMS_MODULE)
+    if module is not None and os.path.realpath(module.__file__) == CHECKPOINT_PARAMS_PATH:
+        return module
+    spec = importlib.util.spec_from_file_location(CHECKPOINT_PARAMS_MODULE, CHECKPOINT_PARAMS_PATH)
+    module = importlib.util.module_from_spec(spec)
+    if CHECKPOINT_PARAMS_MODULE not in sys.modules: # another utils package owns the name otherwise
+        sys.modules[CHECKPOINT_PARAMS_MODULE] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+get_params_from_zip = _import_checkpoint_params().get_params_from_zip
 
 def evaluate_policy_more(model, env, n_eval_episodes=10, 
                     render=False, callback=None, reward_threshold=None,
-                    return_episode_rewards=False):
+                    return_episode_rewards=False, accumulators=None, pre_step_callback=None):
     """
     Runs policy for `n_eval_episodes` episodes and returns average reward.
     This is made to work only with one env.
@@ -49,6 +63,10 @@ def evaluate_policy_more(model, env, n_eval_episodes=10,
         this will raise an error if the performance is not met
     :param return_episode_rewards: (bool) If True, a list of reward per episode
         will be returned instead of the mean.
+    :param accumulators: ([EpisodeAccumulator]) online summaries (see episode_accumulators.py),
+        updated after every step and every episode. Read them with their result() afterwards.
+    :param pre_step_callback: (callable) called with (locals, globals) before each step, while `obs` and
+        `state` are still those the agent is about to act on (e.g. to record values as get_model_data does).
     :return: (float, float) Mean reward per episode, std of reward per episode
         returns ([float], [int]) when `return_episode_rewards` is True
     """
@@ -63,6 +81,8 @@ def evaluate_policy_more(model, env, n_eval_episodes=10,
         episode_length = 0
         tow_counts = np.zeros((2,))
         while not done:
+            if pre_step_callback is not None:
+                pre_step_callback(locals(), globals())
             action, state = model.predict(obs, state=state)
             obs, reward, done, info = env.step(action)
             episode_reward += reward
@@ -70,9 +90,15 @@ def evaluate_policy_more(model, env, n_eval_episodes=10,
             
             if callback is not None:
                 callback(locals(), globals())
+            if accumulators is not None:
+                for accumulator in accumulators:
+                    accumulator.step(reward, state, info)
             episode_length += 1
             if render:
                 env.render()
+        if accumulators is not None:
+            for accumulator in accumulators:
+                accumulator.end_episode(episode_reward, episode_length, tow_counts)
         ep_tow_counts.append( tow_counts) 
         episode_rewards.append(episode_reward)
         episode_lengths.append(episode_length)
@@ -273,6 +299,24 @@ def make_env(env_id, rank, seed=0):
     return _init
 
 
+def make_eval_model(env_id='vrgym-v0', n_lstm=64):
+    """
+    Builds a single env and an untrained CnnLstmPolicy A2C model on it, the same way
+    evaluate_policies.ipynb does. Load weights into it with model.load_parameters.
+
+    :param env_id: (str) the environment ID
+    :param n_lstm: (int) number of LSTM units of the policy
+    :return: (DummyVecEnv, A2C) the env and the model
+    """
+    import custom_cnn_lstm # registers vrgym-v0 and defines the cnn extractor the checkpoints were trained with
+
+    env = DummyVecEnv([lambda: gym.make(env_id)])
+    policy_kwargs = dict(n_lstm=n_lstm, cnn_extractor=custom_cnn_lstm.nature_cnn_best_rewinput)
+    model = A2C(CnnLstmPolicy, env, policy_kwargs=policy_kwargs,
+                learning_rate=2.5e-4, n_steps=140)
+    return env, model
+
+
 
 
 
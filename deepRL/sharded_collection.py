@@ -0,0 +1,186 @@
+
+import numpy as np
+
+import multiprocessing as mp
+import os
+import pickle
+from scipy.io import loadmat, savemat
+
+import evaluate_policy
+
+# fields returned by get_model_data(..., by_ep = True), in order
+MODEL_DATA_FIELDS = ['actions', 'rewards', 'obses', 'feats', 'terms', 'vs', 'tow_counts', 'episode_lengths', 'ypositions']
+
+# one env and one model per worker process, built once by _init_worker
+_worker_env = None
+_worker_model = None
+
+
+def plan_shards(n_eval_episodes, num_shards):
+    """
+    Splits N episodes into contiguous global episode ranges.
+
+    :param n_eval_episodes: (int) total number of episodes
+    :param num_shards: (int) number of shards
+    :return: ([(int, int, int)]) (shard index, first episode, one past the last episode)
+    """
+    bounds = np.linspace(0, n_eval_episodes, num_shards + 1).astype(int)
+    return [(int(i), int(bounds[i]), int(bounds[i + 1])) for i in np.arange(num_shards) if bounds[i + 1] > bounds[i]]
+
+
+def shard_path(shard_dir, shard_i):
+    return os.path.join(shard_dir, 'shard_{:03d}.p'.format(shard_i))
+
+
+def shard_log_path(shard_dir, shard_i):
+    # ExperimentLog.logExtras appends _HHMM to a log file that does not exist yet, so the
+    # file actually written is read back from MATLAB once the shard is done
+    return os.path.join(os.path.abspath(shard_dir), 'trialinfo_shard_{:03d}.mat'.format(shard_i))
+
+
+def _init_worker(env_id, n_lstm, load_path):
+    global _worker_env, _worker_model
+    _worker_env, _worker_model = evaluate_policy.make_eval_model(env_id, n_lstm)
+    _worker_model.load_parameters(evaluate_policy.get_params_from_zip(load_path))
+
+
+def _collect_shard(job):
+    shard_i, start, stop, shard_dir, obses_ep_saved, seed = job
+    vr_env = _worker_env.envs[0]
+    # every shard runs in a fresh process (and MATLAB engine), and its trial counter starts at 0 like a
+    # serial run, so the 500-trial blocks of its log start where they should. the shard's own log file
+    # keeps workers started in the same minute from writing into the same HHMM-named file
+    assert vr_env.trial == 0, 'worker was reused for a second shard'
+    vr_env.eng.eval("global vr; vr.logger.logFile = '{}';".format(shard_log_path(shard_dir, shard_i)), nargout=0)
+    if seed is not None: # initializeVR shuffles MATLAB's rng; reseed so the shard draws the same stimuli every run
+        vr_env.eng.rng(float(seed + shard_i), nargout=0)
+
+    shard_obses_saved = int(np.clip(obses_ep_saved - start, 0, stop - start))
+    model_data = evaluate_policy.get_model_data(_worker_model, _worker_env, n_eval_episodes=stop - start,
+                                                by_ep=True, obses_ep_saved=shard_obses_saved)
+    shard = dict(zip(MODEL_DATA_FIELDS, model_data))
+    shard['obses'] = shard['obses'][:shard_obses_saved]
+
+    # final compact write of the shard's trial log, and where it went
+    vr_env.eng.eval("global vr; vr.logger.save(true, vr.timeElapsed, {:d}); shard_log_file = vr.logger.logFile;"
+                    .format(vr_env.thread_id), nargout=0)
+    shard.update(shard_i=shard_i, start=start, stop=stop, trial_info_path=vr_env.eng.workspace['shard_log_file'])
+
+    # write to a temporary name first, so a half-written shard never looks finished
+    path = shard_path(shard_dir, shard_i)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(shard, f)
+    os.replace(path + '.tmp', path)
+    return shard_i
+
+
+def load_shards(shard_paths):
+    """
+    Loads shard pickles, sorted by their first episode, and checks they cover the episodes without gaps.
+
+    :param shard_paths: ([str]) shard pickle files (any order)
+    :return: ([dict]) the shards
+    """
+    shards = []
+    for path in shard_paths:
+        with open(path, 'rb') as f:
+            shards.append(pickle.load(f))
+    shards.sort(key=lambda shard: shard['start'])
+    for (prev, curr) in zip(shards[:-1], shards[1:]):
+        assert prev['stop'] == curr['start'], 'missing episodes {:d} to {:d}'.format(prev['stop'], curr['start'])
+    return shards
+
+
+def merge_shards(shards):
+    """
+    Concatenates shards back into one dataset, in global episode order.
+
+    :param shards: ([dict]) shards, as returned by load_shards
+    :return: (list) [actions, rewards, obses, feats, terms, vs, tow_counts, episode_lengths, ypositions]
+        in the same layout as get_model_data(..., by_ep = True)
+    """
+    merged = []
+    for field in MODEL_DATA_FIELDS:
+        if field == 'episode_lengths':
+            merged.append(np.hstack([shard[field] for shard in shards]))
+        else:
+            merged.append([ep for shard in shards for ep in shard[field]])
+    return merged
+
+
+def load_trials(trial_info_path):
+    """
+    Trials of one trial info .mat: its 'trials' struct array, or all trials of the blocks of an
+    ExperimentLog 'log' (as each shard writes it), in order.
+
+    :param trial_info_path: (str) .mat file
+    :return: (np.ndarray) 1 x num_trials 'trials' struct array, as loadmat(...)['trials']
+    """
+    saved = loadmat(trial_info_path)
+    if 'trials' in saved:
+        return saved['trials']
+    blocks = saved['log']['block'][0, 0]
+    return np.concatenate([blocks[0, b]['trial'] for b in np.arange(blocks.shape[1])], axis=1)
+
+
+def merge_trial_info(shards):
+    """
+    Concatenates the ViRMEn trial info saved by each shard's worker, in global episode order, and
+    checks it lines up with the episodes.
+
+    :param shards: ([dict]) shards, as returned by load_shards
+    :return: (np.ndarray) 1 x num_episodes 'trials' struct array, as loadmat(...)['trials']
+    """
+    trials_by_shard = []
+    for shard in shards:
+        trials = load_trials(shard['trial_info_path'])
+        num_episodes = shard['stop'] - shard['start']
+        # a trial still in progress when the shard stopped is logged too, so only the first ones are kept
+        assert trials.shape[1] >= num_episodes, \
+            '{} has {:d} trials for {:d} episodes'.format(shard['trial_info_path'], trials.shape[1], num_episodes)
+        trials_by_shard.append(trials[:, :num_episodes])
+    return np.concatenate(trials_by_shard, axis=1)
+
+
+def collect_model_data(load_path, n_eval_episodes, shard_dir, num_workers=4, obses_ep_saved=10,
+                       seed=None, env_id='vrgym-v0', n_lstm=64):
+    """
+    Runs get_model_data for N episodes split across worker processes, each with its own env
+    (and MATLAB engine), model and trial log, and merges the shards into one dataset.
+    Every shard runs in a fresh process, so each log starts at trial 0 like a serial run.
+    Shards already in shard_dir are not recomputed, so an interrupted run can be restarted.
+
+    :param load_path: (str) checkpoint to evaluate, without '.zip'
+    :param n_eval_episodes: (int) total number of episodes
+    :param shard_dir: (str) folder the shards and their trial logs are written to
+    :param num_workers: (int) number of worker processes (and shards)
+    :param obses_ep_saved: (int) observations are kept for this many episodes, counted globally
+    :param seed: (int) if given, shard i seeds MATLAB's rng with seed + i
+    :param env_id: (str) the registered gym environment ID
+    :param n_lstm: (int) number of LSTM units of the policy
+    :return: (list, np.ndarray) same as get_model_data(..., by_ep = True), and the 1 x N 'trials' struct
+        array of all episodes in the same order
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = plan_shards(n_eval_episodes, num_workers)
+    jobs = [(shard_i, start, stop, shard_dir, obses_ep_saved, seed) for (shard_i, start, stop) in shards
+            if not os.path.exists(shard_path(shard_dir, shard_i))]
+    if len(jobs):
+        # maxtasksperchild = 1: a worker that finished its shard is replaced, never handed a second one
+        with mp.Pool(processes=len(jobs), initializer=_init_worker, initargs=(env_id, n_lstm, load_path),
+                     maxtasksperchild=1) as pool:
+            for shard_i in pool.imap_unordered(_collect_shard, jobs):
+                print('finished shard {:d}'.format(shard_i))
+    loaded = load_shards([shard_path(shard_dir, shard_i) for (shard_i, _, _) in shards])
+    model_data = merge_shards(loaded)
+    assert len(model_data[MODEL_DATA_FIELDS.index('episode_lengths')]) == n_eval_episodes, \
+        'shards in {} were written for a different number of episodes or workers'.format(shard_dir)
+    return model_data, merge_trial_info(loaded)
+
+
+if __name__ == "__main__":
+    load_path = './logs/retrain_wgoat/success1/'
+    model_data, trials = collect_model_data(load_path + 'rl_model_28800000_steps', 5000, load_path + 'shards/',
+                                            num_workers=5, obses_ep_saved=1000)
+    pickle.dump(model_data, open(load_path + '5000t_sharded.p', 'wb'))
+    savemat(load_path + 'trialinfo_sharded.mat', {'trials': trials})
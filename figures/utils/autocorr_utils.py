@@ -0,0 +1,115 @@
+import numpy as np
+
+from .episode_array import EpisodeArray
+
+
+#### TEMPORAL AUTOCORRELATION ACROSS EPISODES
+# Figure 3 computes autocorrelations of one averaged run-through of the maze. StreamingAutocorr instead
+# pools the per-lag statistics of every episode, so the autocorrelation of features (or flattened
+# observations) can use thousands of trials. For every lag l and feature it keeps
+#     sum_t x_t * x_{t+l},  sum_t x_t,  sum_t x_{t+l},  sum_t x_t^2,  sum_t x_{t+l}^2  and the number of pairs
+# over all pairs (t, t + l) inside an episode (pairs never cross episodes), which is enough for the
+# Pearson correlation at each lag. Episodes are added a chunk at a time and then thrown away.
+
+FFT_MIN_LAG = 32 # 'auto' uses the FFT from this many lags on
+
+
+def _next_fast_len(n):
+    # smallest power of 2 >= n, good enough for np.fft
+    return int(2 ** np.ceil(np.log2(max(n, 1))))
+
+
+class StreamingAutocorr(object):
+    """
+    per-lag, per-feature autocorrelation pooled over episodes of different lengths
+    max_lag: largest lag (in timesteps) kept
+    method: 'direct' (one product per lag), 'fft' (all lags from one zero-padded FFT per chunk of episodes)
+            or 'auto' (fft for max_lag >= FFT_MIN_LAG)
+    """
+    def __init__(self, max_lag, method = 'auto'):
+        assert method in ('auto', 'direct', 'fft')
+        self.max_lag = int(max_lag)
+        self.method = ('fft' if self.max_lag >= FFT_MIN_LAG else 'direct') if method == 'auto' else method
+        self.num_pairs = np.zeros(self.max_lag + 1)
+        self.cross = None # (max_lag + 1) x num_features each, set by the first episode
+        self.lead_sum = self.lag_sum = self.lead_sq = self.lag_sq = None
+
+    def _init_sums(self, num_feats):
+        if self.cross is None:
+            zeros = lambda: np.zeros((self.max_lag + 1, num_feats))
+            self.cross, self.lead_sum, self.lag_sum, self.lead_sq, self.lag_sq = [zeros() for _ in np.arange(5)]
+
+    def update(self, episodes_, chunk_size = 256):
+        """
+        adds episodes: a list (or EpisodeArray) of (num_timesteps) or (num_timesteps x num_features) arrays,
+        handled chunk_size episodes at a time
+        """
+        for start in np.arange(0, len(episodes_), chunk_size):
+            chunk = episodes_[start:start + chunk_size]
+            chunk = chunk.to_list() if isinstance(chunk, EpisodeArray) else chunk
+            chunk = [np.asarray(ep, dtype = float).reshape(len(ep), -1) for ep in chunk]
+            chunk = [ep for ep in chunk if len(ep)]
+            if len(chunk):
+                self._update_chunk(chunk)
+        return self
+
+    def _update_chunk(self, chunk):
+        num_feats = chunk[0].shape[1]
+        self._init_sums(num_feats)
+        lengths = np.array([len(ep) for ep in chunk])
+        lags = np.arange(self.max_lag + 1)
+
+        # episodes zero-padded into one (episodes x max_len x features) block; padding adds nothing to any sum
+        max_len = np.max(lengths)
+        padded = np.zeros((len(chunk), max_len + self.max_lag, num_feats))
+        for (e, ep) in enumerate(chunk):
+            padded[e, :len(ep)] = ep
+
+        # sums over the leading (t < T - l) and lagging (t >= l) part of each episode from prefix sums
+        cum = np.concatenate([np.zeros((len(chunk), 1, num_feats)), np.cumsum(padded[:, :max_len], 1)], 1)
+        cum_sq = np.concatenate([np.zeros((len(chunk), 1, num_feats)), np.cumsum(padded[:, :max_len] ** 2, 1)], 1)
+        lead_end = np.clip(lengths[:, None] - lags[None, :], 0, None) # episodes x lags
+        lag_start = np.minimum(lags[None, :], lengths[:, None])
+        episode_idx = np.arange(len(chunk))[:, None]
+        self.lead_sum += np.sum(cum[episode_idx, lead_end], 0)
+        self.lead_sq += np.sum(cum_sq[episode_idx, lead_end], 0)
+        self.lag_sum += np.sum(cum[episode_idx, lengths[:, None]] - cum[episode_idx, lag_start], 0)
+        self.lag_sq += np.sum(cum_sq[episode_idx, lengths[:, None]] - cum_sq[episode_idx, lag_start], 0)
+        self.num_pairs += np.sum(lead_end, 0)
+
+        if self.method == 'fft':
+            # sum_t x_t x_{t+l} for all lags at once: inverse FFT of the power spectrum, summed over the chunk
+            n_fft = _next_fast_len(max_len + self.max_lag)
+            spectrum = np.fft.rfft(padded[:, :max_len], n = n_fft, axis = 1)
+            power = np.sum(np.abs(spectrum) ** 2, 0)
+            self.cross += np.fft.irfft(power, n = n_fft, axis = 0)[:self.max_lag + 1]
+        else:
+            for lag in lags:
+                self.cross[lag] += np.einsum('etf,etf->f', padded[:, :max_len], padded[:, lag:lag + max_len])
+
+    def autocovariance(self):
+        """
+        output: (max_lag + 1) x num_features covariance between x_t and x_{t+l}, each part centered with its own mean
+        """
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            n = self.num_pairs[:, None]
+            return self.cross / n - (self.lead_sum / n) * (self.lag_sum / n)
+
+    def autocorr(self):
+        """
+        output: lags, (max_lag + 1) x num_features Pearson correlation between x_t and x_{t+l},
+                number of (t, t + l) pairs at each lag. nan for lags no episode is long enough for
+        """
+        n = self.num_pairs[:, None]
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            lead_var = self.lead_sq / n - (self.lead_sum / n) ** 2
+            lag_var = self.lag_sq / n - (self.lag_sum / n) ** 2
+            corr = self.autocovariance() / np.sqrt(lead_var * lag_var)
+        return np.arange(self.max_lag + 1), corr, self.num_pairs
+
+
+def get_autocorr(episodes_, max_lag, method = 'auto', chunk_size = 256):
+    """
+    autocorrelation of each feature pooled over all episodes, see StreamingAutocorr.autocorr
+    """
+    return StreamingAutocorr(max_lag, method).update(episodes_, chunk_size).autocorr()
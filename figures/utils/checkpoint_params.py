@@ -0,0 +1,131 @@
+import numpy as np
+import zipfile
+import io
+import os
+import json
+from collections.abc import Mapping
+from functools import lru_cache
+
+
+#### LOADING TRAINED WEIGHTS
+# Shared by deepRL/evaluate_policy.py and figures/utils/cnnlstm_analysis_utils.py.
+# A stable baselines checkpoint <load_path>.zip holds a "parameters" member, which is itself an
+# npz archive with one array per tensor (keys like 'model/vf/w:0').
+# Opened checkpoints are cached per process, keyed on the path and modification time, so that
+# notebooks asking for the same weights over and over only decompress the zip once.
+
+CACHE_SIZE = 8
+EXTRACTED_SUFFIX = '_params'
+EXTRACTED_INDEX = 'index.json'
+
+
+class CheckpointParams(Mapping):
+    """
+    read-only dict-like view of a checkpoint's parameters. tensors are read on first access
+    and kept, so asking for 'model/vf/w:0' does not parse the CNN weights.
+    """
+    def __init__(self, keys, read_tensor, source):
+        self._keys = list(keys)
+        self._read_tensor = read_tensor
+        self._tensors = {}
+        self.source = source
+
+    def __getitem__(self, key):
+        if key not in self._tensors:
+            if key not in self._keys:
+                raise KeyError(key)
+            tensor = self._read_tensor(key)
+            tensor.setflags(write=False) # shared through the cache, so nobody may edit it in place
+            self._tensors[key] = tensor
+        return self._tensors[key]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return 'CheckpointParams({})'.format(self.source)
+
+
+def _open_zip(zip_path):
+    with zipfile.ZipFile(zip_path, 'r') as model_file:
+        parameter_bytes = model_file.read("parameters")
+    # np.load on an in-memory npz is lazy: each array is only parsed when it is asked for
+    parameters = np.load(io.BytesIO(parameter_bytes))
+    return CheckpointParams(parameters.files, lambda key: parameters[key], zip_path)
+
+
+def _open_extracted(extracted_dir):
+    with open(os.path.join(extracted_dir, EXTRACTED_INDEX), 'r') as f:
+        index = json.load(f)
+    read_tensor = lambda key: np.load(os.path.join(extracted_dir, index[key]), mmap_mode='r')
+    return CheckpointParams(index.keys(), read_tensor, extracted_dir)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _open_cached(path, mtime, extracted):
+    # mtime is only part of the key, so a re-saved checkpoint is not served from the cache
+    return _open_extracted(path) if extracted else _open_zip(path)
+
+
+def _extracted_dir(load_path):
+    return load_path + EXTRACTED_SUFFIX
+
+
+def _is_extracted(load_path):
+    index_path = os.path.join(_extracted_dir(load_path), EXTRACTED_INDEX)
+    return os.path.exists(index_path) and \
+        os.path.getmtime(index_path) >= os.path.getmtime(load_path + '.zip')
+
+
+def load_checkpoint(load_path, use_extracted=True):
+    """
+    gets the (cached, lazily read) parameters of a checkpoint
+    input: load_path: path of the checkpoint without the '.zip', as for get_params_from_zip
+           use_extracted: memory-map the .npy files from extract_checkpoint if they are up to date
+    output: CheckpointParams, a read-only mapping from tensor name to array
+    """
+    load_path = os.path.abspath(load_path)
+    if use_extracted and _is_extracted(load_path):
+        extracted_dir = _extracted_dir(load_path)
+        index_path = os.path.join(extracted_dir, EXTRACTED_INDEX)
+        return _open_cached(extracted_dir, os.path.getmtime(index_path), True)
+    zip_path = load_path + '.zip'
+    return _open_cached(zip_path, os.path.getmtime(zip_path), False)
+
+
+def extract_checkpoint(load_path):
+    """
+    writes every tensor of a checkpoint to its own uncompressed .npy file in <load_path>_params/,
+    which load_checkpoint memory-maps from then on. does nothing if it is already up to date.
+    output: the folder the tensors were written to
+    """
+    load_path = os.path.abspath(load_path)
+    extracted_dir = _extracted_dir(load_path)
+    if _is_extracted(load_path):
+        return extracted_dir
+    os.makedirs(extracted_dir, exist_ok=True)
+    params = load_checkpoint(load_path, use_extracted=False)
+    index = {}
+    for (i, key) in enumerate(params):
+        filename = '{:03d}_{}.npy'.format(i, key.replace('/', '_').replace(':', '_'))
+        np.save(os.path.join(extracted_dir, filename), params[key])
+        index[key] = filename
+    # the index goes last: it marks the extraction as complete
+    with open(os.path.join(extracted_dir, EXTRACTED_INDEX), 'w') as f:
+        json.dump(index, f, indent=1)
+    return extracted_dir
+
+
+def clear_checkpoint_cache():
+    _open_cached.cache_clear()
+
+
+def get_params_from_zip(load_path):
+    """
+    all parameters of a checkpoint as a dict, e.g. for model.load_parameters.
+    the arrays are shared with the cache and read-only; copy one before editing it.
+    """
+    return dict(load_checkpoint(load_path))
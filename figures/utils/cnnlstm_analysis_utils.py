@@ -3,24 +3,27 @@ import matplotlib.pyplot as plt
 import matplotlib
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from mpl_toolkits.mplot3d import Axes3D
 import os
-import zipfile
-import io
 
-
-#### DATA MANIPULATION
+from .checkpoint_params import get_params_from_zip, load_checkpoint, extract_checkpoint
+from .episode_array import EpisodeArray, as_flat
 
 
-def get_params_from_zip(load_path):
-    model_file = zipfile.ZipFile(load_path + '.zip', "r")
-    parameter_bytes = model_file.read("parameters")
-    parameter_buffer = io.BytesIO(parameter_bytes)
-    parameters = dict(np.load(parameter_buffer))
-    model_file.close()
-    return parameters
+#### DATA MANIPULATION
 
-def split_by_ep_len(feature, episode_lengths):
+"""
+split_by_ep_len: splits data stacked over episodes back into episodes
+inputs >> feature: stacked data (num_timesteps_total x ...), or an EpisodeArray
+          episode_lengths: length of each episode (ignored for an EpisodeArray, which knows its own)
+          as_episode_array: return an EpisodeArray (no copy) instead of a list of arrays
+"""
+def split_by_ep_len(feature, episode_lengths, as_episode_array = False):
+    if isinstance(feature, EpisodeArray):
+        return feature if as_episode_array else feature.to_list()
+    if as_episode_array:
+        return EpisodeArray.from_lengths(feature, np.asarray(episode_lengths).astype(int))
     idx = np.cumsum(episode_lengths)[:-1].astype(int)
     return np.split(feature, idx, axis = 0)
 
@@ -36,55 +39,103 @@ def extract_field(trial_struc, fieldname):
 
 
 """
-bin_data_by_ypos: bins data by yposition given some 1D data that is the same size as ypositions.
-inputs >> data_: data that is a list of 1D data, with length num_trials
-          ypositions: ypositions for each point of data grouped by trials
-          pos_bins: marks the bins for yposition
-output >> binned_data: a (num_trials x num_bins) matrix that averages the data within each bin.
+bin_sums: sums and counts of data within bins, in one bincount pass for all features
+inputs >> bin_idx: bin of each data point (num_points), integers in [0, num_bins)
+          data: num_points or (num_points x num_features) data
+          num_bins: number of bins
+output >> sums: (num_bins x num_features) sum of the data in each bin
+          counts: (num_bins) number of data points in each bin
+"""
+def bin_sums(bin_idx, data, num_bins):
+    data = np.asarray(data, dtype=float).reshape(len(bin_idx), -1)
+    num_feats = data.shape[1]
+    flat_idx = (np.asarray(bin_idx)[:, None] * num_feats + np.arange(num_feats)).ravel()
+    sums = np.bincount(flat_idx, weights=data.ravel(), minlength=num_bins * num_feats).reshape(num_bins, num_feats)
+    counts = np.bincount(bin_idx, minlength=num_bins)
+    return sums, counts
+
+
+"""
+nan_bin_sums: like bin_sums, but nans are left out (as np.nanmean would), so the counts are per feature
+output >> sums: (num_bins x num_features) sum of the non-nan data in each bin
+          counts: (num_bins x num_features) number of non-nan data points in each bin
+"""
+def nan_bin_sums(bin_idx, data, num_bins):
+    data = np.asarray(data, dtype=float).reshape(len(bin_idx), -1)
+    # a sparse (num_bins x num_points) one-hot matrix times the data is a bincount for all features at once,
+    # and much faster than a flat bincount when there are many features
+    one_hot = sparse.csr_matrix((np.ones(len(bin_idx)), (bin_idx, np.arange(len(bin_idx)))), shape=(num_bins, len(bin_idx)))
+    counts = np.repeat(np.bincount(bin_idx, minlength=num_bins)[:, None], data.shape[1], axis=1)
+    isnan = np.isnan(data)
+    if not np.any(isnan):
+        return one_hot.dot(data), counts
+    data = data.copy()
+    data[isnan] = 0
+    nan_counts = one_hot.astype(np.float32).dot(isnan.view(np.uint8))
+    return one_hot.dot(data), counts - np.rint(nan_counts).astype(int)
+
+
+"""
+bin_data_by_ypos: bins data by yposition given some data that is the same size as ypositions.
+                  all trials are binned at once, for any number of features.
+inputs >> data_: data that is a list (or EpisodeArray) of length num_trials, each entry 1D (num_timesteps) or
+                 2D (num_timesteps x num_features)
+          ypositions: ypositions for each point of data grouped by trials (list or EpisodeArray)
+          pos_bins: marks the bins for yposition. column i of the output holds the points with
+                    np.digitize(ypos, pos_bins) == i; points that land past the last column are dropped
+output >> binned_data: a (num_trials x num_bins) matrix for 1D data, (num_trials x num_bins x num_features)
+                       for 2D data, that averages the data within each bin.
                        nan if nothing in the bin so we can nanmean correctly
 """
 def bin_data_by_ypos(data_, ypositions, pos_bins):
     num_trials = len(ypositions)
     num_bins = len(pos_bins) - 1
-    ypos_bins_ = [np.digitize(ypositions[trial], pos_bins) for trial in np.arange(num_trials)]
+    ypos_flat, trial_lens = as_flat(ypositions)
+    data, _ = as_flat(data_[:num_trials])
+    ypos_bins = np.digitize(ypos_flat, pos_bins)
+    trial_idx = np.repeat(np.arange(num_trials), trial_lens)
 
-
-    binned_data = np.full((num_trials, num_bins), np.nan)
-
-    for (trial, data_slice) in enumerate(data_):
-        trial_bins = np.unique(ypos_bins_[trial])
-        binned_data[trial, trial_bins]  = np.array([np.mean(data_slice[ypos_bins_[trial] == i], 0) for i in trial_bins]).T
-    return binned_data
+    in_range = ypos_bins < num_bins
+    sums, counts = bin_sums(trial_idx[in_range] * num_bins + ypos_bins[in_range], data[in_range], num_trials * num_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        binned_data = sums / counts[:, None]
+    binned_data[counts == 0] = np.nan
+    binned_data = binned_data.reshape(num_trials, num_bins, -1)
+    return binned_data[:, :, 0] if data.ndim == 1 else binned_data
 
 
 """
-bin_data_by_ypos2: bins data by yposition given some 1D data that is the same size as ypositions. averages ACROSS all trials, not just within trial
-inputs >> data_: data that is a list of 1D data, with length num_trials
-          ypositions: ypositions for each point of data grouped by trials
-          pos_bins: marks the bins for yposition
+bin_data_by_ypos2: bins data by yposition given some data that is the same size as ypositions. averages ACROSS all trials, not just within trial
+inputs >> data_: data that is a list (or EpisodeArray) of length num_trials, each entry 1D (num_timesteps) or
+                 2D (num_timesteps x num_features)
+          ypositions: ypositions for each point of data grouped by trials (list or EpisodeArray)
+          pos_bins: marks the bins for yposition. bin i holds the points with np.digitize(ypos, pos_bins) == i + 1
           trials: the trials to bin over. default is all trials. enter indices to slice accordingly
-output >> binned_data: a (num_trials x num_bins) matrix that averages the data within each bin.
-                       nan if nothing in the bin so we can nanmean correctly
+output >> avg_binned_data: a (num_bins) vector for 1D data, (num_bins x num_features) for 2D data,
+                           that averages the data within each bin over all the given trials.
+                           nan if nothing in the bin
 """
 def bin_data_by_ypos2(data_, ypositions, pos_bins, trials = None):
-    if trials == None:
-         trials = np.arange(len(data_))
-    num_trials = len(ypositions)
+    if trials is None:
+        trials = np.arange(len(data_))
     num_bins = len(pos_bins) - 1
-    ypos_bins_ = [np.digitize(ypositions[trial], pos_bins) for trial in np.arange(num_trials)]
-
-    binned_data = [] # empty to start
-    for trial in trials:
-        data_slice = data_[trial]
-        binned_trial = [data_slice[ypos_bins_[trial] == bin_i] for bin_i in np.arange(1,num_bins + 1)]
+    if len(trials) == 0: # no trials: all bins are empty, as for trials without data in range
+        feature_shape = np.shape(data_[0])[1:] if len(data_) else ()
+        return np.full((num_bins,) + feature_shape, np.nan)
+    if isinstance(data_, EpisodeArray) or isinstance(ypositions, EpisodeArray):
+        data, _ = as_flat(data_[trials] if isinstance(data_, EpisodeArray) else [data_[trial] for trial in trials])
+        ypos_flat, _ = as_flat(ypositions[trials] if isinstance(ypositions, EpisodeArray) else [ypositions[trial] for trial in trials])
+    else:
+        data = np.concatenate([np.asarray(data_[trial]) for trial in trials])
+        ypos_flat = np.concatenate([ypositions[trial] for trial in trials])
+    ypos_bins = np.digitize(ypos_flat, pos_bins) - 1
 
-        if len(binned_data) == 0:
-            binned_data = np.array(binned_trial)
-        else:
-            binned_data = np.array([np.hstack((binned_data[i],binned_trial[i])) for i in np.arange(num_bins)])
-    # average at the end
-    avg_binned_data = np.array([np.mean(trial_vals) for trial_vals in binned_data])
-    return avg_binned_data
+    in_range = (ypos_bins >= 0) & (ypos_bins < num_bins)
+    sums, counts = bin_sums(ypos_bins[in_range], data[in_range], num_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg_binned_data = sums / counts[:, None]
+    avg_binned_data[counts == 0] = np.nan
+    return avg_binned_data[:, 0] if data.ndim == 1 else avg_binned_data
 
 
 
@@ -105,74 +156,96 @@ def plot_binned_data(data, label = '', ax = None, color = None, ypos = []):
 
 
 """
-find_cue_locs:
+align_binned_to_cues: aligns position-binned data to every cue of one or more cue types in one gather
+inputs >> binned_data: (num_trials x num_bins) or (num_trials x num_bins x num_features) data, e.g. from bin_data_by_ypos
+          cuePositions: cue positions per trial (num_trials x num_cue_types, e.g. cuePos_), each entry the positions
+                        of that cue type in that trial
+          pos_bins: the bins used for binned_data (a cue at position p sits in column np.digitize(p, pos_bins))
+          cue_bin_range: (num_bins_before, num_bins_after) around the cue
+          cueTypes: one cue type (int) or a sequence of them
+output >> for each cue type, a num_cues x (num_bins_before + num_bins_after + 1) [x num_features] array,
+          cues in trial order, nan outside the maze. as in find_cue_locs, the last column of binned_data is
+          only used before a cue, never from the cue on
+          a single array if cueTypes is an int, otherwise a list with one array per cue type
 """
-def find_cue_locs(binned_data, cueType, cuePositions, pos_bins, cue_bin_range):
-    num_trials = len(cuePositions)
-    num_bins = len(pos_bins) - 1
-    cue_bins_ = [np.digitize(trial_cues[cueType], pos_bins)[0] for trial_cues in cuePositions]
-    data_by_cue_type = []
-
-    for (t, trial_cue_bins) in enumerate(cue_bins_):
-    # only try to get the cues if there are cues in this trial
-        if len(trial_cue_bins):
-            # get the data positioned at cue
-            cue_region_after = [binned_data[t, np.arange(cue_idx, int(min(binned_data.shape[1] - 1, cue_idx + cue_bin_range[1] + 1)))]
-                                                                            for cue_idx in trial_cue_bins]
-            cue_region_before = [binned_data[t, np.arange(int(max(0, cue_idx - cue_bin_range[0])), cue_idx) ]
-                                                                            for cue_idx in trial_cue_bins]
-            # fill in any missing data for the last cue
-            cue_region_after[-1] = np.hstack((cue_region_after[-1], np.full((cue_bin_range[1] + 1 - len(cue_region_after[-1]),),np.nan)))
-            cue_region_before[0] = np.hstack((np.full((cue_bin_range[0]  - len(cue_region_before[0]),),np.nan), cue_region_before[0]))
-
-            # put it all together
-            data_by_cue_type.append(np.hstack(([np.vstack(cue_region_i) for cue_region_i in [cue_region_before, cue_region_after]])))
-
-
-
-    return np.vstack(data_by_cue_type)
-
+def align_binned_to_cues(binned_data, cuePositions, pos_bins, cue_bin_range, cueTypes = (0, 1)):
+    binned_data = np.asarray(binned_data, dtype = float)
+    cue_types = np.atleast_1d(cueTypes)
+    num_before, num_after = int(cue_bin_range[0]), int(cue_bin_range[1])
+    num_usable = binned_data.shape[1] - 1
+
+    # cue bin, trial and cue type of every cue, in trial order within each cue type
+    cue_bins_, cue_trials_, cue_type_idx_ = [], [], []
+    for (k, cueType) in enumerate(cue_types):
+        trial_cue_bins = [np.ravel(np.digitize(trial_cues[cueType], pos_bins)) for trial_cues in cuePositions]
+        cue_bins_ += trial_cue_bins
+        cue_trials_.append(np.repeat(np.arange(len(trial_cue_bins)), [len(cue_bins) for cue_bins in trial_cue_bins]))
+        cue_type_idx_.append(np.full(sum(len(cue_bins) for cue_bins in trial_cue_bins), k))
+    cue_bins = np.concatenate(cue_bins_ + [np.zeros(0, dtype=int)]).astype(int)
+    cue_trials = np.concatenate(cue_trials_)
+    cue_type_idx = np.concatenate(cue_type_idx_)
+
+    # pad with nans so every window is in bounds: column c of binned_data is column c + num_before of padded
+    num_pad_after = max(num_after + 1, int(np.max(cue_bins, initial=0)) + num_after + 1 - binned_data.shape[1])
+    pad_shape = lambda num_pad: (binned_data.shape[0], num_pad) + binned_data.shape[2:]
+    padded = np.concatenate([np.full(pad_shape(num_before), np.nan), binned_data,
+                             np.full(pad_shape(num_pad_after), np.nan)], axis = 1)
+    window_cols = cue_bins[:, None] + np.arange(num_before + num_after + 1)[None, :]
+    aligned = padded[cue_trials[:, None], window_cols]
+    # the bins from the cue on stop before the last column, the bins before the cue do not
+    aligned[:, num_before:][window_cols[:, num_before:] - num_before >= num_usable] = np.nan
+
+    aligned_by_type = [aligned[cue_type_idx == k] for k in np.arange(len(cue_types))]
+    return aligned_by_type[0] if np.ndim(cueTypes) == 0 else aligned_by_type
 
 
 """
-find_cue_locs:
+find_cue_locs: binned data aligned to each cue of type cueType (see align_binned_to_cues)
+output >> num_cues x (cue_bin_range[0] + cue_bin_range[1] + 1) [x num_features]
 """
-def find_cue_locs_unbinned(binned_data, cueType, cuePositions, pos_bins, cue_bin_range):
-    num_trials = len(cuePositions)
-    num_bins = len(pos_bins) - 1
-    cue_bins_ = [np.digitize(trial_cues[cueType], pos_bins)[0] for trial_cues in cuePositions]
-    data_by_cue_type = []
-
-    for (t, trial_cue_bins) in enumerate(cue_bins_):
-    # only try to get the cues if there are cues in this trial
-        if len(trial_cue_bins):
-            # get the data positioned at cue
-            cue_region_after = [binned_data[t, np.arange(cue_idx, int(min(binned_data.shape[1] - 1, cue_idx + cue_bin_range[1] + 1)))]
-                                                                            for cue_idx in trial_cue_bins]
-            cue_region_before = [binned_data[t, np.arange(int(max(0, cue_idx - cue_bin_range[0])), cue_idx) ]
-                                                                            for cue_idx in trial_cue_bins]
-            # fill in any missing data for the last cue
+def find_cue_locs(binned_data, cueType, cuePositions, pos_bins, cue_bin_range):
+    return align_binned_to_cues(binned_data, cuePositions, pos_bins, cue_bin_range, int(cueType))
 
-            cue_region_after[-1] = np.hstack((cue_region_after[-1], np.full((cue_bin_range[1] + 1 - len(cue_region_after[-1]),),np.nan)))
-            cue_region_before[0] = np.hstack((np.full((cue_bin_range[0]  - len(cue_region_before[0]),),np.nan), cue_region_before[0]))
 
-            # put it all together
-            data_by_cue_type.append(np.hstack(([np.vstack(cue_region_i) for cue_region_i in [cue_region_before, cue_region_after]])))
+# used to be a copy of find_cue_locs
+find_cue_locs_unbinned = find_cue_locs
 
 
+"""
+timelock_to_events: aligns activity to every event (e.g. cue onsets) of every trial in one gather
+inputs >> activity_: list (or EpisodeArray) of length NUM_TRIALS, each entry NUM_TIMESTEPS or NUM_TIMESTEPS x NUM_UNITS
+          events_: event timesteps PER trial, list of length NUM_TRIALS, each entry a vector of timesteps
+          num_steps_before, num_steps_after: window is [event - num_steps_before, event + num_steps_after)
+output >> (num_events x window) or (num_events x window x NUM_UNITS) array, events in trial order,
+          nan wherever the window leaves its trial (before the start or after the end, for any event)
+"""
+def timelock_to_events(activity_, events_, num_steps_before = 5, num_steps_after = 25):
+    data, trial_lens = as_flat(activity_)
+    trial_starts = np.concatenate([[0], np.cumsum(trial_lens)[:-1]]).astype(int)
+    events_ = [np.ravel(trial_events).astype(int) for trial_events in events_]
+    event_trial = np.repeat(np.arange(len(events_)), [len(trial_events) for trial_events in events_])
+    event_steps = np.concatenate(events_ + [np.zeros(0, dtype=int)])
+
+    # gather indices of every window into the flat data; points outside the trial read index 0 and are masked after
+    window_steps = event_steps[:, None] + np.arange(-num_steps_before, num_steps_after)[None, :]
+    in_trial = (window_steps >= 0) & (window_steps < trial_lens[event_trial][:, None])
+    flat_idx = np.where(in_trial, trial_starts[event_trial][:, None] + window_steps, 0)
+
+    dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else float
+    if len(data) == 0:
+        return np.full(flat_idx.shape + data.shape[1:], np.nan, dtype = dtype)
+    timelocked = data[flat_idx].astype(dtype)
+    timelocked[~in_trial] = np.nan
+    return timelocked
 
-    return np.vstack(data_by_cue_type)
 
 """
 pes_: Vector RPE data in list form, list of length NUM_TRIALS, each entry is NUM_TIMESTEPS x NUM_UNITS
 cueLocs: cue locations PER trial, in list form, list of length NUM_TRIALS, each entry is vector with location of cues
+output >> NUM_CUES x (num_steps_before + num_steps_after) x NUM_UNITS, all units aligned at once
 """
-
-
-def get_timelocked_cues(pes_, cueLocs):
-    num_feats = pes_[0].shape[1]
-    return np.dstack(
-        [timelock_to_cue(pes_, cueLocs, pes_i) for pes_i in np.arange(num_feats)])
+def get_timelocked_cues(pes_, cueLocs, num_steps_before = 5, num_steps_after = 25):
+    return timelock_to_events(pes_, cueLocs, num_steps_before, num_steps_after)
 
 
 
@@ -180,59 +253,75 @@ def get_timelocked_cues(pes_, cueLocs):
 given some raw activity, timelock to cues (cue type determined by the cueOnset)
 in this version, activity is given by ALL units, then it takes the num_unit needed.
 """
-def timelock_to_cue(activity, cueOnset, num_unit):
-    num_steps_after = 25
-    num_steps_before = 5
-    all_act_after_cue = []
-    for (t, trial_cue_idx) in enumerate(cueOnset):
-        if len(trial_cue_idx):
-            trial_act = activity[t][:,num_unit]
-            act_after_cue = [trial_act[max(0,idx - num_steps_before):min(idx+num_steps_after , len(trial_act))] for idx in trial_cue_idx]
-
-            act_after_cue[0] = np.hstack((np.full((num_steps_before + num_steps_after - len(act_after_cue[0]),),np.nan), act_after_cue[0]))
-            act_after_cue[-1] =  np.hstack((act_after_cue[-1], np.full((num_steps_before + num_steps_after - len(act_after_cue[-1]),),np.nan)))
-            all_act_after_cue.append(np.vstack(act_after_cue))
-    return np.vstack(all_act_after_cue)
+def timelock_to_cue(activity, cueOnset, num_unit, num_steps_before = 5, num_steps_after = 25):
+    if isinstance(activity, EpisodeArray):
+        activity_unit = activity.map(lambda data: data[:, num_unit])
+    else:
+        activity_unit = [trial_act[:, num_unit] for trial_act in activity[:len(cueOnset)]]
+    return timelock_to_events(activity_unit, cueOnset, num_steps_before, num_steps_after)
 
 """
 given some raw activity, timelock to cues (cue type determined by the cueOnset)
 This function is specialized for idealRPEs since not just the last cue can be
+too close to the end of the trial (timelock_to_events handles that for any cue)
 """
-def timelock_to_cue_i(activity_i, cueOnset):
-    num_steps_after = 25
-    num_steps_before = 5
-    all_act_after_cue = []
-    for (t, trial_cue_idx) in enumerate(cueOnset):
-        if len(trial_cue_idx):
-            trial_act = activity_i[t]
-            act_after_cue = [trial_act[max(0,idx - num_steps_before):min(idx+num_steps_after , len(trial_act))] for idx in trial_cue_idx]
-
-            act_after_cue[0] = np.hstack((np.full((num_steps_before + num_steps_after - len(act_after_cue[0]),),np.nan), act_after_cue[0]))
-            after_cue_limit = (trial_cue_idx + num_steps_after) > len(trial_act) # determine the cues that go too far (might not just be the last cue)
-            for cueOnset_i in np.where(after_cue_limit)[0]:
-                act_after_cue[cueOnset_i] =  np.hstack((act_after_cue[cueOnset_i], np.full((num_steps_before + num_steps_after - len(act_after_cue[cueOnset_i]),),np.nan)))
-            all_act_after_cue.append(np.vstack(act_after_cue))
-    return np.vstack(all_act_after_cue)
+def timelock_to_cue_i(activity_i, cueOnset, num_steps_before = 5, num_steps_after = 25):
+    return timelock_to_events(activity_i, cueOnset, num_steps_before, num_steps_after)
 
 
 """
 bin_data_by_vpos: bins data by vposition given a series of data
-inputs >> data: data that is a matrix of data with rows num_timesteps * num_trials and columns of num_features
-          vpositions: vpositions that has same number of rows
+inputs >> data: data that is a matrix of data with rows num_timesteps * num_trials and columns of num_features,
+                or a list (or EpisodeArray) of it per trial
+          vpositions: vpositions that has same number of rows, in the same layout as data
           bin_size: size of the view angle bins
-output >> va_bins: the bins of view angle for the binned data
-          binned_data: a (num_bins x num_features ) vector that averages data within the bin
+          return_bins: also return the view angle bins (default only returns binned_data, whatever the bin_size)
+output >> va_bins: (only with return_bins) all the view angle bin edges, np.arange(min, max + bin_size, bin_size)
+          binned_data: a (num_features x num_bins) matrix that nan-averages data within the bin,
+                       with one column per view angle bin that has any data
 """
-def bin_data_by_vpos(data, vpositions, bin_size = 0.05):
+def bin_data_by_vpos(data, vpositions, bin_size = 0.05, return_bins = False):
+    flatten = lambda x: np.asarray(x) if isinstance(x, np.ndarray) else as_flat(x)[0]
+    data = np.asarray(flatten(data), dtype = float)
+    vpositions = np.ravel(flatten(vpositions))
     va_bins = np.arange(np.min(vpositions), np.max(vpositions)+ bin_size, bin_size)
     vpos_bin_idx = np.digitize(vpositions, va_bins)
 
-    binned_data = np.array([np.nanmean(data[vpos_bin_idx == i],0) for i in np.unique(vpos_bin_idx)]).T
+    sums, counts = nan_bin_sums(vpos_bin_idx, data, len(va_bins) + 1)
+    occupied = np.flatnonzero(np.bincount(vpos_bin_idx, minlength = len(va_bins) + 1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        binned_data = (sums[occupied] / counts[occupied]).T
+    binned_data = binned_data[0] if data.ndim == 1 else binned_data
 
-    if bin_size != 0.05:
+    if return_bins:
         return (va_bins, binned_data)
-    else:
-        return binned_data
+    return binned_data
+
+
+"""
+bin_data_by_ypos_vpos: joint yposition x view angle binning of data, in one pass for all features
+inputs >> data: (num_points) or (num_points x num_features) data, or lists (or EpisodeArrays) of it per trial
+          ypositions, vpositions: yposition and view angle of each point, same layout as data
+          pos_bins, va_bins: bin edges. bin i is between edges i and i + 1, points outside are dropped
+output >> sums: (num_pos_bins x num_va_bins x num_features) sum of the non-nan data in each bin
+          counts: same shape, number of non-nan points in each bin
+          means: sums / counts, nan for empty bins
+"""
+def bin_data_by_ypos_vpos(data, ypositions, vpositions, pos_bins, va_bins):
+    flatten = lambda x: np.asarray(x) if isinstance(x, np.ndarray) else as_flat(x)[0]
+    data, ypositions, vpositions = flatten(data), np.ravel(flatten(ypositions)), np.ravel(flatten(vpositions))
+    num_pos_bins, num_va_bins = len(pos_bins) - 1, len(va_bins) - 1
+    ypos_bins = np.digitize(ypositions, pos_bins) - 1
+    vpos_bins = np.digitize(vpositions, va_bins) - 1
+
+    in_range = (ypos_bins >= 0) & (ypos_bins < num_pos_bins) & (vpos_bins >= 0) & (vpos_bins < num_va_bins)
+    joint_bins = ypos_bins[in_range] * num_va_bins + vpos_bins[in_range]
+    sums, counts = nan_bin_sums(joint_bins, np.asarray(data)[in_range], num_pos_bins * num_va_bins)
+    sums = sums.reshape(num_pos_bins, num_va_bins, -1)
+    counts = counts.reshape(num_pos_bins, num_va_bins, -1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    return sums, counts, means
 
 
 """
@@ -240,8 +329,61 @@ autocorr calculates mean-corrected dot product across time of a matrix
 inputs> mat: matrix with ROWS of observations across time.(so timesteps x shape)
 """
 def covar_mat(mat):
-    mat = np.vstack([mat_i - np.mean(mat_i) for mat_i in mat])
+    mat = np.asarray(mat, dtype = float).reshape(len(mat), -1)
+    mat = mat - np.mean(mat, 1, keepdims = True)
     return mat.dot(mat.T)
+
+
+#### VECTOR RPEs ####
+"""
+compute_vector_rpes: per-feature (vector) RPEs of every step, as in the figure notebooks:
+          pes[i] = rewards[i] / nfeatures + w_val * (-feats[i] + gamma * feats[i + 1])   if not terms[i]
+          pes[i] = rewards[i] / nfeatures - w_val * feats[i]                             if terms[i]
+          computed for all steps at once with the features shifted by one step
+inputs >> feats: num_steps x nfeatures LSTM features, episodes stacked (or a list/EpisodeArray of episodes)
+          rewards, terms: reward and episode end of each step (stacked, or lists per episode)
+          w_val: value weights (nfeatures), e.g. np.squeeze(params['model/vf/w:0'])
+          gamma: discount factor, or a vector of them
+          next_feats: features of the step after the last one (e.g. the first step of the next chunk).
+                      if None, the last step is terminal (the notebook loop left it at 0)
+          dtype: output dtype, default float32 for float32 features and float64 otherwise
+output >> pes: num_steps x nfeatures (num_gammas x num_steps x nfeatures for a vector of gammas)
+"""
+def compute_vector_rpes(feats, rewards, terms, w_val, gamma = 0.99, next_feats = None, dtype = None):
+    flatten = lambda x: np.asarray(x) if isinstance(x, np.ndarray) else as_flat(x)[0]
+    feats = flatten(feats)
+    dtype = (np.float32 if feats.dtype == np.float32 else np.float64) if dtype is None else dtype
+    feats = feats.astype(dtype, copy = False)
+    rewards = np.ravel(flatten(rewards)).astype(dtype, copy = False)
+    terms = np.ravel(flatten(terms)).astype(bool)
+    gammas = np.atleast_1d(gamma).astype(dtype)
+    nfeatures = feats.shape[1]
+
+    value_feats = np.asarray(w_val, dtype = dtype) * feats
+    next_value_feats = np.empty_like(value_feats)
+    next_value_feats[:-1] = value_feats[1:]
+    next_value_feats[-1:] = 0 if next_feats is None else np.asarray(w_val, dtype = dtype) * np.asarray(next_feats, dtype = dtype)
+    next_value_feats[terms] = 0
+
+    pes = (rewards[:, None] / dtype(nfeatures) - value_feats)[None] + gammas[:, None, None] * next_value_feats[None]
+    return pes[0] if np.ndim(gamma) == 0 else pes
+
+
+"""
+iter_vector_rpes: compute_vector_rpes over a stream of chunks, e.g. shards of model data that do not fit
+          in memory together. each chunk is (feats, rewards, terms) for consecutive steps; chunks may split episodes
+output >> yields the pes of each chunk in order (the last step of the last chunk is terminal)
+"""
+def iter_vector_rpes(chunks, w_val, gamma = 0.99, dtype = None):
+    prev_chunk = None
+    for chunk in chunks:
+        if prev_chunk is not None:
+            yield compute_vector_rpes(*prev_chunk, w_val, gamma, next_feats = np.asarray(chunk[0])[0], dtype = dtype)
+        prev_chunk = chunk
+    if prev_chunk is not None:
+        yield compute_vector_rpes(*prev_chunk, w_val, gamma, dtype = dtype)
+
+
 #### IPEs #####
 
 
@@ -252,48 +394,64 @@ get_ipes: computes the ideal RPE PEs and Value given a value function and sequen
 
 val_fn: the value function computed with the ideal RPEs. Shaped num_states x steps_per_trial
         num_states is the possible belief states the agent can be in
+        can also be a stack of value functions (e.g. from value_iteration with several pcorr),
+        shaped num_fns x num_states x steps_per_trial
 bs:    sequence of belief states. Shaped steps_per_trial x num_trials
+output: ipes, ivalues, each num_trials x steps_per_trial (num_fns x num_trials x steps_per_trial for a stack)
 """
 def get_ipes(val_fn, bs):
-
+    val_fn = np.asarray(val_fn)
+    bs = np.asarray(bs).astype(int)
     stepspertrial = bs.shape[0]
     ntrials = bs.shape[1]
-    ipes = np.zeros((ntrials, stepspertrial))
-    ivalues = np.zeros((ntrials, stepspertrial))
 
-    for trial in np.arange(ntrials):
+    # the state before step 0 is state 0 of column 0 (expectation before seeing anything)
+    curr_states = bs.T
+    prev_states = np.hstack((np.zeros((ntrials, 1), dtype = int), curr_states[:, :-1]))
+    steps = np.arange(stepspertrial)[None, :]
 
-        ipes[trial,0] = val_fn[bs[0, trial], 1] - val_fn[0,0] # first step
-        ivalues[trial,0] = val_fn[0, 0]
-        for step in np.arange(1,stepspertrial):
-            ipes[trial, step] = val_fn[bs[step, trial],step + 1]-val_fn[bs[step-1, trial],step] # 2nd step
-            ivalues[trial, step] = val_fn[bs[step-1, trial], step]
+    ivalues = val_fn[..., prev_states, steps]
+    ipes = val_fn[..., curr_states, steps + 1] - ivalues
 
     return ipes, ivalues
 
 """
 value_iteration: performs value iteration given some belief state (the absolute value of difference of towers)
                  and psychometric curve
+inputs >> bs: belief states, num_trials x num_steps (ints 0 .. num_states - 1)
+          pcorr: P(reward) for each final belief state, length num_states, or a stack of
+                 psychometric curves (num_curves x num_states) solved together
+output >> V: num_states x (num_steps + 1) value function (num_curves x num_states x (num_steps + 1) for a stack)
+         column 0 is the expectation before seeing anything (only its state 0 is used),
+         column l + 1 the value of each belief state at step l. states never visited at a step get 0
 """
 # value iteration to compute reward probability given running abs diff at each step
-# steps 2-141 are following each 14cm state, step 1 is prior to trial starting
+# (in the task: 140 steps following each 14cm state and 7 possible abs running count diffs b (0-6))
 def value_iteration(bs, pcorr):
-    V = np.zeros((141,7)) # 141 steps x 7 possible abs running count diffs b (0-6) at each step
-    V[140,:] = pcorr
-    # backward induction
-    for level in np.flip(np.arange(139)):
-        for state in np.arange(7):
-            succs = bs[bs[:,level] == state,level+1] # running counts at next steps
-            psucc = np.array([np.mean(succs == x) if np.sum(succs == x) > 0 else 0 for x in np.arange(7)]) # how likely we reach each state
-            V[level+1,state] = np.dot(psucc, V[level+2,:])  # bellman
-
-
-	# final case: expectation before seeing anything
-    succs = bs[:,0]
-    psucc = np.array([np.mean(succs == x) for x in np.arange(7)])
-    V[0,0] = np.dot(psucc, V[1,:])
-
-    return V.T
+    bs = np.asarray(bs).astype(int)
+    pcorr = np.asarray(pcorr, dtype = float)
+    num_states = pcorr.shape[-1]
+    num_trials, num_steps = bs.shape
+    assert np.all((bs >= 0) & (bs < num_states)), 'belief states must be in 0 .. num_states - 1'
+
+    # P(next state | state) at every step, from the counts of all (step, state, next state) triples at once
+    pair_idx = (np.arange(num_steps - 1)[None, :] * num_states + bs[:, :-1]) * num_states + bs[:, 1:]
+    trans_counts = np.bincount(pair_idx.ravel(), minlength = (num_steps - 1) * num_states ** 2)
+    trans_counts = trans_counts.reshape(num_steps - 1, num_states, num_states).astype(float)
+    state_counts = trans_counts.sum(2, keepdims = True)
+    trans_probs = np.divide(trans_counts, state_counts, out = np.zeros_like(trans_counts), where = state_counts > 0)
+
+    # backward induction, all psychometric curves at once (one column each)
+    V = np.zeros((num_steps + 1, num_states) + pcorr.shape[:-1])
+    V[num_steps] = np.moveaxis(pcorr, -1, 0)
+    for level in np.flip(np.arange(num_steps - 1)):
+        V[level + 1] = np.tensordot(trans_probs[level], V[level + 2], axes = 1) # bellman
+
+    # final case: expectation before seeing anything
+    psucc = np.bincount(bs[:, 0], minlength = num_states) / num_trials
+    V[0, 0] = np.tensordot(psucc, V[1], axes = 1)
+
+    return np.moveaxis(V, (0, 1), (-1, -2))
 #### OTHER ####
 """
 Given the tower difference for each trial, get the indices for
@@ -316,16 +474,84 @@ def plot_cues(ax, cuePos_trial, colors = ['k', 'r']):
 
 
 #### PCA UTILS ####
-def get_singular_vals(feats):
+# feats can be one stacked (datapoints x features) array, or per-episode features (a list of arrays or an
+# EpisodeArray, possibly memory-mapped) that are streamed chunk_size episodes at a time, so PCA over 15K+
+# episodes of LSTM features never needs the stacked matrix in memory.
+
+def iter_feature_chunks(feats, chunk_size = 500):
+        """
+        yields (datapoints x features) float64 blocks of chunk_size consecutive episodes
+        input: feat: stacked features (yielded as one block), list of per-episode features or EpisodeArray
+        """
+        if isinstance(feats, np.ndarray):
+            yield np.asarray(feats, dtype = float)
+            return
+        for start in np.arange(0, len(feats), chunk_size):
+            if isinstance(feats, EpisodeArray):
+                yield np.asarray(feats[start:start + chunk_size].data, dtype = float)
+            else:
+                yield np.vstack(feats[start:start + chunk_size]).astype(float)
+
+def get_streaming_cov(feats, chunk_size = 500):
+        """
+        mean and covariance (same as np.cov(feats, rowvar = False), so ddof = 1) accumulated chunk by chunk,
+        merging the per-chunk statistics so that large offsets do not lose precision
+        output: mean: (features), C: (features x features), n: number of datapoints
+        """
+        n, mean, M2 = 0, 0., 0.
+        for chunk in iter_feature_chunks(feats, chunk_size):
+            n_chunk = len(chunk)
+            if n_chunk == 0:
+                continue
+            mean_chunk = np.mean(chunk, 0)
+            chunk0 = chunk - mean_chunk
+            delta = mean_chunk - mean
+            M2 = M2 + chunk0.T @ chunk0 + np.outer(delta, delta) * n * n_chunk / (n + n_chunk)
+            mean = mean + delta * n_chunk / (n + n_chunk)
+            n += n_chunk
+        return (mean, M2 / (n - 1), n)
+
+def get_randomized_pcs(feats, num_pcs, mean, n, chunk_size = 500, num_oversamples = 10, num_iters = 4, seed = 0):
+        """
+        top num_pcs PC's by randomized subspace iteration on the covariance. every iteration is one pass over
+        the chunks (only ever holding features x (num_pcs + num_oversamples)), so feats has to be re-iterable
+        input: mean, n: from get_streaming_cov
+        output: PC's (features x num_pcs) and their singular values (num_pcs), ordered
+        """
+        def cov_dot(Q): # C @ Q without forming C
+            CQ = 0.
+            for chunk in iter_feature_chunks(feats, chunk_size):
+                chunk0 = chunk - mean
+                CQ = CQ + chunk0.T @ (chunk0 @ Q)
+            return CQ / (n - 1)
+
+        num_feats = len(mean)
+        rng = np.random.RandomState(seed)
+        Q = np.linalg.qr(rng.normal(size = (num_feats, min(num_feats, num_pcs + num_oversamples))))[0]
+        for _ in np.arange(num_iters):
+            Q = np.linalg.qr(cov_dot(Q))[0]
+        S, V = np.linalg.eigh(Q.T @ cov_dot(Q))
+        order = np.argsort(S)[::-1][:num_pcs]
+        return (Q @ V[:, order], S[order])
+
+def get_singular_vals(feats, num_pcs = None, randomized = False, chunk_size = 500, seed = 0):
         """
         gets singular values from features
-        input: feat: features with datapoints x features
+        input: feat: features with datapoints x features, or per-episode features (list or EpisodeArray)
+               num_pcs: only keep the top num_pcs PC's. default is all
+               randomized: find the top num_pcs with get_randomized_pcs instead of a full SVD (needs num_pcs)
         output: PC's: PC's in column form, ordered
                 singular values: (1 x features )
         """
-        C = np.cov(feats, rowvar = False)
+        assert not (randomized and num_pcs is None), 'randomized PCA needs num_pcs'
+        if isinstance(feats, np.ndarray) and num_pcs is None and not randomized:
+            C = np.cov(feats, rowvar = False)
+        else:
+            mean, C, n = get_streaming_cov(feats, chunk_size)
+            if randomized:
+                return get_randomized_pcs(feats, num_pcs, mean, n, chunk_size, seed = seed)
         U, S, V = np.linalg.svd(C)
-        return (U, S)
+        return (U[:, :num_pcs], S[:num_pcs])
 def get_var_captured(S, ax = None, var_limits = [0.5, 0.9, 0.98], ):
     """
     """
@@ -345,15 +571,24 @@ def get_var_captured(S, ax = None, var_limits = [0.5, 0.9, 0.98], ):
         ax.axhline(0.5, color = 'k', alpha = 0.5)
         ax.axhline(0.9, color = 'k', alpha = 0.5)
     return (var_captured, PC_needed)
-def get_pca_proj(feats, pc):
+def get_pca_proj(feats, pc, mean = None):
     """
     gets the pca projection
     input: feat: the features, with datapoints x features
            pc: the PC's (i.e. U from the PCA)
+           mean: the mean to center with (e.g. from get_streaming_cov). default is the mean of feats
     """
-    feats0 = feats - np.mean(feats,0)
+    feats0 = feats - (np.mean(feats,0) if mean is None else mean)
     proj = feats0 @ pc
     return proj
+def iter_pca_proj(feats, pc, mean, chunk_size = 500):
+    """
+    gets the pca projection chunk by chunk (chunk_size episodes at a time, see iter_feature_chunks)
+    input: mean: the mean of all the features, e.g. from get_streaming_cov
+    output: yields (datapoints x num_pcs) projections in episode order
+    """
+    for chunk in iter_feature_chunks(feats, chunk_size):
+        yield get_pca_proj(chunk, pc, mean)
 
 
 def plot_proj(proj, num_dim = 2):
@@ -397,7 +632,7 @@ def get_d_prime(lre_response, hre_response):
 
 
 # must be FEAT x TIMESTEPS
-norm_within_feat = lambda feat_by_bins: np.vstack([(row_feat - np.min(row_feat))/(np.max(row_feat) - np.min(row_feat)) for row_feat in feat_by_bins])
+norm_within_feat = lambda feat_by_bins: (feat_by_bins - np.min(feat_by_bins, 1, keepdims = True)) / np.ptp(feat_by_bins, 1, keepdims = True)
 sort_by_max_loc = lambda act: np.argsort(np.argmax(act,1))
 sort_by_max = lambda act: np.argsort(np.max(act,1))
 
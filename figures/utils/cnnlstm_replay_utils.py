@@ -0,0 +1,135 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .cnnlstm_analysis_utils import get_params_from_zip, split_by_ep_len, compute_vector_rpes
+
+
+#### TEACHER-FORCED REPLAY OF THE CNN LSTM POLICY
+# Recomputes the LSTM features of a CnnLstmPolicy checkpoint on observations that were already
+# recorded (e.g. obses from evaluate_policy.get_model_data), without running the env.
+# The layers mirror custom_cnn_lstm.nature_cnn_best_rewinput and the stable baselines lstm:
+#   c1 (8x8, stride 2) -> c2 (2x2, stride 1) -> c3 (3x3, stride 2) -> fc1 (128), all relu,
+#   concatenated with the 2 reward-input entries from the last row of the observation,
+#   then lstm1 with gates split in (input, forget, output, candidate) order.
+# The features are the LSTM hidden state ("model/concat_2:0"), the value is model/vf on top of it.
+
+
+def _conv(x, w, b, stride):
+    # VALID conv2d in NHWC, same as stable_baselines.common.tf_layers.conv
+    filter_h, filter_w = w.shape[:2]
+    windows = sliding_window_view(x, (filter_h, filter_w), axis=(1, 2))[:, ::stride, ::stride]
+    return np.tensordot(windows, w.transpose(2, 0, 1, 3), axes=([3, 4, 5], [0, 1, 2])) + b.reshape(-1)
+
+
+def _as_frames(obses):
+    # obses are saved squeezed (num_frames x 69 x 120); the policy sees num_frames x 69 x 120 x 1
+    obses = np.asarray(obses)
+    if obses.ndim == 3:
+        obses = obses[..., None]
+    return obses
+
+
+def get_cnn_feats(params, obses, chunk_size=128, dtype=np.float32):
+    """
+    runs the CNN (plus reward input) part of the policy on a stack of frames
+    input: params: parameter dict from get_params_from_zip
+           obses: num_frames x 69 x 120 (x 1) observations
+           chunk_size: number of frames pushed through the convolutions at once (bounds memory)
+    output: num_frames x 130 inputs to the LSTM
+    """
+    layers = [(np.asarray(params['model/' + name + '/w:0'], dtype), np.asarray(params['model/' + name + '/b:0'], dtype), stride)
+              for (name, stride) in [('c1', 2), ('c2', 1), ('c3', 2)]]
+    w_fc = np.asarray(params['model/fc1/w:0'], dtype)
+    b_fc = np.asarray(params['model/fc1/b:0'], dtype)
+
+    obses = _as_frames(obses)
+    cnn_feats = np.zeros((len(obses), w_fc.shape[1] + 2), dtype)
+    for start in np.arange(0, len(obses), chunk_size):
+        chunk = obses[start:start + chunk_size]
+        activ = chunk[:, :-1, :, :].astype(dtype)
+        for (w, b, stride) in layers:
+            activ = np.maximum(_conv(activ, w, b, stride), 0)
+        activ = activ.reshape(len(chunk), -1)
+        cnn_feats[start:start + len(chunk), :-2] = np.maximum(activ @ w_fc + b_fc, 0)
+        cnn_feats[start:start + len(chunk), -2:] = chunk[:, -1, :2, 0]
+    return cnn_feats
+
+
+def unroll_lstm(params, inputs, episode_lengths, dtype=np.float32):
+    """
+    runs the LSTM over a padded [T, B] batch of episodes, each starting from a zero state
+    input: params: parameter dict from get_params_from_zip
+           inputs: T x B x num_inputs LSTM inputs (padding past each episode's end is ignored)
+           episode_lengths: length B
+    output: T x B x n_lstm hidden states, zero past the end of each episode
+    """
+    w_x = np.asarray(params['model/lstm1/wx:0'], dtype)
+    w_h = np.asarray(params['model/lstm1/wh:0'], dtype)
+    b = np.asarray(params['model/lstm1/b:0'], dtype)
+    n_lstm = w_h.shape[0]
+    sigmoid = lambda x: 1 / (1 + np.exp(-x))
+
+    num_steps, batch_size = inputs.shape[:2]
+    # the input projection does not depend on the recurrence, so do it for all steps at once
+    x_proj = (inputs.reshape(num_steps * batch_size, -1).astype(dtype) @ w_x + b).reshape(num_steps, batch_size, -1)
+    cell_state = np.zeros((batch_size, n_lstm), dtype)
+    hidden = np.zeros((batch_size, n_lstm), dtype)
+    hiddens = np.zeros((num_steps, batch_size, n_lstm), dtype)
+    for t in np.arange(num_steps):
+        gates = x_proj[t] + hidden @ w_h
+        in_gate = sigmoid(gates[:, :n_lstm])
+        forget_gate = sigmoid(gates[:, n_lstm:2 * n_lstm])
+        out_gate = sigmoid(gates[:, 2 * n_lstm:3 * n_lstm])
+        cell_candidate = np.tanh(gates[:, 3 * n_lstm:])
+        cell_state = forget_gate * cell_state + in_gate * cell_candidate
+        hidden = out_gate * np.tanh(cell_state)
+        hiddens[t] = hidden
+    hiddens[np.arange(num_steps)[:, None] >= np.asarray(episode_lengths)[None, :]] = 0
+    return hiddens
+
+
+def replay_cnnlstm(params, obses_, rewards_, episode_lengths=None, gamma=0.99,
+                   batch_size=1000, chunk_size=128, dtype=np.float32):
+    """
+    teacher-forced recomputation of features, values and vector RPEs from recorded observations.
+    the recorded observations are fed in as they are, so the checkpoint's own actions never matter.
+    input: params: parameter dict from get_params_from_zip, or the load_path of the checkpoint
+           obses_: list of num_timesteps x 69 x 120 observations per episode,
+                   or all episodes stacked if episode_lengths is given
+           rewards_: rewards per episode (or stacked, same as obses_)
+           episode_lengths: if given, obses_ and rewards_ are split by these lengths
+           gamma: discount factor for the vector RPEs
+           batch_size: number of episodes unrolled together
+           chunk_size: number of frames pushed through the convolutions at once
+    output: feats_, vs_, pes_: lists of per-episode features (num_timesteps x n_lstm),
+            values (num_timesteps) and vector RPEs (num_timesteps x n_lstm)
+    """
+    if isinstance(params, str):
+        params = get_params_from_zip(params)
+    if episode_lengths is not None:
+        obses_ = split_by_ep_len(obses_, episode_lengths)
+        rewards_ = split_by_ep_len(rewards_, episode_lengths)
+    w_val = np.squeeze(params['model/vf/w:0']).astype(dtype)
+    b_val = np.squeeze(params['model/vf/b:0']).astype(dtype)
+
+    feats_, vs_, pes_ = [], [], []
+    for start in np.arange(0, len(obses_), batch_size):
+        batch_obses = obses_[start:start + batch_size]
+        batch_lengths = np.array([len(obses_i) for obses_i in batch_obses])
+        cnn_feats = split_by_ep_len(get_cnn_feats(params, np.concatenate(batch_obses), chunk_size, dtype), batch_lengths)
+
+        # pad into T x B so the LSTM runs on all episodes of the batch at once
+        padded = np.zeros((np.max(batch_lengths), len(batch_obses), cnn_feats[0].shape[1]), dtype)
+        for (b, cnn_feats_i) in enumerate(cnn_feats):
+            padded[:len(cnn_feats_i), b] = cnn_feats_i
+        hiddens = unroll_lstm(params, padded, batch_lengths, dtype)
+
+        for (b, length) in enumerate(batch_lengths):
+            feats = hiddens[:length, b]
+            rewards = np.asarray(rewards_[start + b], dtype).reshape(-1)
+            # per-feature PEs as in the figure notebooks, the last step of the episode is terminal
+            pes = compute_vector_rpes(feats, rewards, np.arange(length) == length - 1, w_val, gamma, dtype = dtype)
+            feats_.append(feats)
+            vs_.append(feats @ w_val + b_val)
+            pes_.append(pes)
+    return feats_, vs_, pes_
@@ -11,6 +11,10 @@ from scipy.io import loadmat, savemat
 from matplotlib import gridspec
 import os
 import scipy
+from scipy.linalg import blas
+from collections import OrderedDict
+import multiprocessing as mp
+from functools import partial
 
 ########## EXPECTILE IMPUTATION ###########
 
@@ -41,7 +45,8 @@ def expectile_hess(samples, expectiles, taus):
     return np.diag(np.sum(2*tau_factors, -1)) / n_atoms
 
 
-def get_expectiles(samples, taus):
+def get_expectiles_lbfgs(samples, taus):
+    # the original optimizer, kept to validate get_expectiles against
     expectiles_init = np.zeros(len(taus))
 
     def func(e): return expectile_loss(
@@ -57,6 +62,46 @@ def get_expectiles(samples, taus):
     return result["x"]
 
 
+def get_expectiles(samples, taus):
+    """
+    exact expectiles of finite sample sets (the minimizers of expectile_loss), from sorting and prefix sums.
+    with x sorted and k samples <= e, the expectile solves (1 - tau) * sum(e - x[:k]) = tau * sum(x[k:] - e), so
+        e = ((1 - tau) * S_k + tau * (T - S_k)) / ((1 - tau) * k + tau * (n - k))
+    where S_k is the sum of the k smallest samples and T the sum of all. k is found for every tau with one
+    binary search: x[i] is below the tau expectile iff r_i = A_i / (A_i + B_i) <= tau, with A_i = sum(x[i] - x[:i+1])
+    and B_i = sum(x[i+1:] - x[i]), and r_i grows with i
+    :param samples: num_samples, or num_sets x num_samples
+    :param taus: num_expectiles, or num_sets x num_expectiles
+    :return: expectiles, num_expectiles or num_sets x num_expectiles
+    """
+    single = np.ndim(samples) == 1 and np.ndim(taus) == 1
+    samples = np.sort(np.atleast_2d(samples).astype(float), 1)
+    if np.ndim(taus) == 2:  # one sample set for several rows of taus
+        samples = np.broadcast_to(samples, (np.shape(taus)[0], samples.shape[1]))
+    num_sets, n = samples.shape
+    taus = np.broadcast_to(np.asarray(taus, dtype=float), (num_sets, np.shape(taus)[-1]))
+
+    cumsums = np.cumsum(samples, 1)
+    totals = cumsums[:, -1:]
+    i = np.arange(n)
+    below = (i + 1) * samples - cumsums  # A_i
+    above = (totals - cumsums) - (n - i - 1) * samples  # B_i
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratios = np.where(below + above > 0, below / (below + above), 0.)
+
+    # one searchsorted for all sets: offsetting set b by 2b keeps the flattened ratios sorted
+    offsets = 2. * np.arange(num_sets)[:, None]
+    k = np.searchsorted((ratios + offsets).ravel(), (taus + offsets).ravel(), side='right').reshape(taus.shape)
+    k = np.clip(k - n * np.arange(num_sets)[:, None], 1, max(n - 1, 1))
+
+    S_k = np.take_along_axis(cumsums, k - 1, 1)
+    numer = (1 - taus) * S_k + taus * (totals - S_k)
+    denom = (1 - taus) * k + taus * (n - k)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expectiles = np.where(denom > 0, numer / denom, np.take_along_axis(samples, k - 1, 1))
+    return expectiles[0] if single else expectiles
+
+
 def imputation_loss(samples, expectiles, taus):
     return expectile_grad(samples, expectiles, taus)
 
@@ -69,24 +114,10 @@ def imputation_grad(samples, expectiles, taus):
     return -2*tau_factors / n_atoms
 
 
-def fit_samples(expectiles, taus):
-    success = False
-    trial = 0
-    while trial < 10 and not success:
-        samples_init = np.random.uniform(low=expectiles.min() - 1e-2,
-                                         high=expectiles.max() + 1e-2,
-                                         size=len(expectiles))
-
-        def fcn(e): return imputation_loss(
-            samples=e, expectiles=expectiles, taus=taus)
-        def jac(e): return imputation_grad(
-            samples=e, expectiles=expectiles, taus=taus)
-        result = scipy.optimize.root(
-            fcn, jac=jac, x0=samples_init, method="lm")
-        samples = result["x"]
-        success = result["success"]
-        trial += 1
-    return samples
+def fit_samples(expectiles, taus, seed=0):
+    # used to retry scipy's lm from np.random.uniform starts until it succeeded; see fit_samples_batch
+    samples, _ = fit_samples_batch(expectiles[None, :], taus, seed=seed, verbose=False)
+    return samples[0]
 
 
 def expectile_grad_loss(expectiles, taus, dist):
@@ -137,6 +168,451 @@ def infer_dist(expectiles=None, taus=None, dist=None):
     return sol['x']
 
 
+########## SORTED EVALUATION ###########
+
+# the functions above build dense num_expectiles x num_samples deltas. the versions below sort the samples
+# once per call and get the sums over the samples on either side of each expectile from prefix sums, so
+# the loss and gradient take O(n log n + m log n) time and O(n + m) memory. the samples are centered
+# first, which keeps the prefix sums of squares from cancelling for distributions far from 0.
+
+
+def _side_sums(samples, expectiles):
+    # count, sum and sum of squares of the (centered) samples <= each expectile, plus the totals
+    center = np.mean(samples)
+    x = np.sort(samples - center)
+    e = expectiles - center
+    cumsums = np.concatenate([[0.], np.cumsum(x)])
+    cumsqs = np.concatenate([[0.], np.cumsum(x ** 2)])
+    k = np.searchsorted(x, e, side='right')
+    return e, k, cumsums[k], cumsqs[k], len(x), cumsums[-1], cumsqs[-1]
+
+
+def expectile_loss_sorted(samples, expectiles, taus):
+    """ expectile_loss from prefix sums """
+    e, k, S_k, Q_k, n, S, Q = _side_sums(samples, expectiles)
+    below = Q_k - 2 * e * S_k + k * e ** 2  # sum of (x - e) ** 2 over x <= e
+    above = (Q - Q_k) - 2 * e * (S - S_k) + (n - k) * e ** 2
+    return np.sum((1. - taus) * below + taus * above) / n
+
+
+def expectile_grad_sorted(samples, expectiles, taus):
+    """ expectile_grad from prefix sums """
+    e, k, S_k, _, n, S, _ = _side_sums(samples, expectiles)
+    return -2 * ((1. - taus) * (S_k - k * e) + taus * ((S - S_k) - (n - k) * e)) / n
+
+
+def expectile_hess_sorted(samples, expectiles, taus):
+    """ expectile_hess from the number of samples on either side of each expectile """
+    k = np.searchsorted(np.sort(samples), expectiles, side='right')
+    n = len(samples)
+    return np.diag(2 * ((1. - taus) * k + taus * (n - k))) / n
+
+
+def imputation_grad_sorted(samples, expectiles, taus):
+    """
+    imputation_grad without the float deltas: the output is itself num_expectiles x num_samples, so only
+    the boolean comparison of each sample with each expectile is built
+    """
+    above = samples[None, :] > expectiles[:, None]
+    return -2 * np.where(above, taus[:, None], 1. - taus[:, None]) / len(samples)
+
+
+def expectile_grad_loss_sorted(expectiles, taus, dist):
+    """ expectile_grad_loss from prefix sums """
+    return expectile_grad_sorted(dist, expectiles, taus)
+
+
+########## BATCHED IMPUTATION ###########
+
+# infer_dist(expectiles, taus) solves expectile_grad_loss(expectiles, taus, x) = 0 for one set of samples x
+# at a time. imputation_system and infer_dist_batch do the same for a whole batch of expectile vectors
+# (e.g. every timestep x trial of Figure 7 Part 2) with one Levenberg-Marquardt iteration over all of them.
+# the residuals are piecewise linear in the samples, so plain Gauss-Newton often stalls at a kink. the
+# step function (tau if x > e else 1 - tau) is first replaced by a sigmoid of width smoothing * std(expectiles),
+# which is shrunk stage by stage, and only the last stage solves the exact system.
+
+
+STALL_DECREASE, STALL_ITERS = 1e-4, 5  # a row stops after this many steps in a row that reduce its cost less
+
+
+def imputation_system(samples, expectiles, taus, smoothing=None):
+    """
+    residuals (expectile_grad_loss) and their jacobian for a batch of sample sets
+    :param samples: num_sets x num_samples
+    :param expectiles: num_sets x num_expectiles
+    :param taus: num_expectiles, or num_sets x num_expectiles
+    :param smoothing: None for the exact system, else the width of the sigmoid step per set (num_sets)
+    :return: residuals (num_sets x num_expectiles), jacobian wrt the samples (num_sets x num_expectiles x num_samples)
+    """
+    taus = np.broadcast_to(taus, expectiles.shape)[:, :, None]
+    n_atoms = samples.shape[1]
+    deltas = samples[:, None, :] - expectiles[:, :, None]
+    if smoothing is None:
+        tau_factors = np.where(deltas > 0, taus, 1. - taus)
+        jac = -2 * tau_factors / n_atoms
+    else:
+        width = np.reshape(smoothing, (-1, 1, 1))
+        step = 0.5 * (1 + np.tanh(deltas / (2 * width)))  # logistic sigmoid of deltas / width
+        tau_factors = 1. - taus + (2 * taus - 1) * step
+        jac = -2 * (tau_factors + deltas * (2 * taus - 1) * step * (1 - step) / width) / n_atoms
+    residuals = -2 * np.sum(deltas * tau_factors, 2) / n_atoms
+    return residuals, jac
+
+
+def _lm_stage(samples, expectiles, taus, smoothing, max_iter, tol):
+    # levenberg-marquardt on every row at once, each with its own damping (nielsen's update).
+    # rows stop once their largest residual is below tol or the damping blows up (stuck at a kink)
+    num_sets, n = samples.shape
+    residuals, jac = imputation_system(samples, expectiles, taus, smoothing)
+    cost = np.sum(residuals ** 2, 1)
+    damping, nu = np.full(num_sets, 1e-3), np.full(num_sets, 2.)
+    num_iters, num_stalls = np.zeros(num_sets, dtype=int), np.zeros(num_sets, dtype=int)
+
+    for _ in np.arange(max_iter):
+        active = np.flatnonzero((np.max(np.abs(residuals), 1) > tol) & (damping < 1e16) & (num_stalls < STALL_ITERS))
+        if len(active) == 0:
+            break
+        num_iters[active] += 1
+        J, r = jac[active], residuals[active]
+        Jt = np.swapaxes(J, 1, 2)
+        JtJ = Jt @ J
+        grad = (Jt @ r[:, :, None])[:, :, 0]
+        diag_max = np.max(np.einsum('bii->bi', JtJ), 1)
+        A = JtJ + ((damping[active] + 1e-14) * diag_max)[:, None, None] * np.eye(n)
+        step = -np.linalg.solve(A, grad[:, :, None])[:, :, 0]
+
+        new_samples = samples[active] + step
+        new_residuals, new_jac = imputation_system(new_samples, expectiles[active], taus[active],
+                                                   None if smoothing is None else smoothing[active])
+        new_cost = np.sum(new_residuals ** 2, 1)
+        predicted = -np.sum(step * (2 * grad + (JtJ @ step[:, :, None])[:, :, 0]), 1)
+        gain = (cost[active] - new_cost) / np.maximum(predicted, 1e-300)
+        better = new_cost < cost[active]
+        accept, reject = active[better], active[~better]
+        stalled = better & (new_cost > (1 - STALL_DECREASE) * cost[active])
+        num_stalls[active] = np.where(stalled, num_stalls[active] + 1, 0)
+        samples[accept], residuals[accept], jac[accept], cost[accept] = \
+            new_samples[better], new_residuals[better], new_jac[better], new_cost[better]
+        damping[accept] *= np.maximum(1 / 3., 1 - (2 * gain[better] - 1) ** 3)
+        nu[accept] = 2.
+        damping[reject] *= nu[reject]
+        nu[reject] *= 2
+    return samples, residuals, num_iters
+
+
+def infer_dist_batch(expectiles, taus, x0=None, tol=1e-10, max_iter=100, smoothing=(1., 1e-5), num_stages=12,
+                     stage_iters=20, verbose=True):
+    """
+    imputes a distribution (as many samples as expectiles) for every row of expectiles at once
+    :param expectiles: num_sets x num_expectiles (a single vector is treated as one set)
+    :param taus: num_expectiles, or num_sets x num_expectiles
+    :param x0: starting samples, num_sets x num_expectiles. default is the expectiles, as infer_dist
+    :param tol: converged once every residual is below tol * (1 + largest |expectile| of the row)
+    :param max_iter: largest number of iterations of the exact (last) stage
+    :param smoothing: (first, last) sigmoid width, relative to the std of each row's expectiles, of the smoothed
+        stages (log spaced). None goes straight to the exact system
+    :param num_stages, stage_iters: number of smoothed stages and largest number of iterations of each
+    :param verbose: print the sets that did not converge, as check_convergence does
+    :return: samples (num_sets x num_expectiles), dict with 'converged', 'num_iters' (all stages) and 'residual' per set
+    """
+    expectiles = np.atleast_2d(np.asarray(expectiles, dtype=float))
+    taus = np.broadcast_to(np.clip(np.asarray(taus, dtype=float), 0., 1.), expectiles.shape)
+    samples = np.array(expectiles if x0 is None else np.atleast_2d(x0), dtype=float)
+    num_sets = len(samples)
+    scale = tol * (1 + np.max(np.abs(expectiles), 1))
+    num_iters = np.zeros(num_sets, dtype=int)
+
+    if smoothing is not None:
+        spread = np.std(expectiles, 1) + 1e-8
+        for width in np.logspace(np.log10(smoothing[0]), np.log10(smoothing[1]), num_stages):
+            samples, _, stage_num_iters = _lm_stage(samples, expectiles, taus, width * spread, stage_iters, scale)
+            num_iters += stage_num_iters
+    samples, residuals, stage_num_iters = _lm_stage(samples, expectiles, taus, None, max_iter, scale)
+    num_iters += stage_num_iters
+
+    converged = np.max(np.abs(residuals), 1) <= scale
+    info = {'converged': converged, 'num_iters': num_iters, 'residual': np.max(np.abs(residuals), 1)}
+    if verbose and not np.all(converged):
+        failed = np.flatnonzero(~converged)
+        print('{:d} of {:d} imputations did not converge (sets {})'.format(len(failed), num_sets, failed[:20]))
+    return samples, info
+
+
+def _fit_samples_chunk(chunk, expectiles, taus, chunk_size, warm_start, num_restarts, seed, solver_kwargs):
+    # starts, in order: the expectiles, the previous row's solution, then seeded uniform draws over the
+    # range of the expectiles (as fit_samples used to). every start only runs on the rows still unsolved
+    rows = np.arange(chunk * chunk_size, min((chunk + 1) * chunk_size, len(expectiles)))
+    expectiles = expectiles[rows]
+    taus = taus[rows]
+    samples, info = infer_dist_batch(expectiles, taus, verbose=False, **solver_kwargs)
+    residual, num_iters = info['residual'], info['num_iters']
+    converged, start = info['converged'], np.zeros(len(rows), dtype=int)
+
+    def retry(todo, x0, start_idx):
+        new_samples, new_info = infer_dist_batch(expectiles[todo], taus[todo], x0=x0, verbose=False, **solver_kwargs)
+        num_iters[todo] += new_info['num_iters']
+        better = new_info['residual'] < residual[todo]
+        samples[todo[better]], residual[todo[better]] = new_samples[better], new_info['residual'][better]
+        converged[todo] |= new_info['converged']
+        start[todo[new_info['converged']]] = start_idx
+
+    if warm_start:
+        # the previous row's solution, in rounds, so a row solved this way can seed the next one
+        tried = np.zeros(len(rows), dtype=bool)
+        while True:
+            todo = np.flatnonzero(~converged[1:] & converged[:-1] & ~tried[1:]) + 1
+            if len(todo) == 0:
+                break
+            tried[todo] = True
+            retry(todo, samples[todo - 1], 1)
+
+    rng = np.random.RandomState([seed, chunk])
+    for restart in np.arange(num_restarts):
+        todo = np.flatnonzero(~converged)
+        if len(todo) == 0:
+            break
+        low, high = expectiles[todo].min(1, keepdims=True) - 1e-2, expectiles[todo].max(1, keepdims=True) + 1e-2
+        retry(todo, low + (high - low) * rng.random_sample(expectiles[todo].shape), 2 + restart)
+    start[~converged] = -1
+    return samples, {'converged': converged, 'num_iters': num_iters, 'residual': residual, 'start': start}
+
+
+def fit_samples_batch(expectiles, taus, warm_start=True, num_restarts=10, seed=0, chunk_size=1000,
+                      num_workers=None, verbose=True, **solver_kwargs):
+    """
+    deterministic fit_samples for a batch of expectile sets: infer_dist_batch from the expectiles, then for
+    the unsolved rows from the previous row's solution (rows are e.g. consecutive timesteps), then from up to
+    num_restarts uniform draws seeded with RandomState([seed, chunk]), so results do not depend on global rng
+    state or on num_workers
+    :param expectiles: num_sets x num_expectiles
+    :param taus: num_expectiles, or num_sets x num_expectiles
+    :param chunk_size: rows solved together (and seeded together). warm starts do not cross chunks
+    :param num_workers: spread the chunks over this many processes. default is to not use a pool
+    :param solver_kwargs: passed on to infer_dist_batch
+    :return: samples (num_sets x num_expectiles), dict with 'converged', 'num_iters' (all attempts), 'residual'
+        and 'start' per set (0 expectiles, 1 previous row, 2 + k k-th random restart, -1 failed)
+    """
+    expectiles = np.atleast_2d(np.asarray(expectiles, dtype=float))
+    taus = np.broadcast_to(np.asarray(taus, dtype=float), expectiles.shape)
+    num_chunks = int(np.ceil(len(expectiles) / chunk_size))
+    chunk_fn = partial(_fit_samples_chunk, expectiles=expectiles, taus=taus, chunk_size=chunk_size,
+                       warm_start=warm_start, num_restarts=num_restarts, seed=seed, solver_kwargs=solver_kwargs)
+    if num_workers is None or num_workers <= 1:
+        chunks = [chunk_fn(chunk) for chunk in np.arange(num_chunks)]
+    else:
+        with mp.Pool(processes=num_workers) as pool:
+            chunks = pool.map(chunk_fn, np.arange(num_chunks))
+
+    samples = np.concatenate([chunk[0] for chunk in chunks])
+    info = {key: np.concatenate([chunk[1][key] for chunk in chunks]) for key in chunks[0][1]}
+    if verbose:
+        starts = np.bincount(np.minimum(info['start'][info['converged']], 2), minlength=3)
+        print('{:d} sets: {:d} solved from the expectiles, {:d} from the previous row, {:d} from a random restart, '
+              '{:d} failed ({:.1%}). median {:.0f} iterations'.format(
+                  len(samples), starts[0], starts[1], starts[2], np.sum(~info['converged']),
+                  np.mean(~info['converged']), np.median(info['num_iters'])))
+    return samples, info
+
+
+class InferDistCache(object):
+    """
+    memo cache for imputed distributions, keyed on (expectiles, taus) rounded to multiples of tol, so
+    near-identical V_next vectors (e.g. early cue-free steps, post-trial padding) are only solved once.
+    a hit returns the samples imputed for the first expectiles that fell in the same bin.
+    only solutions whose largest residual (expectile_grad_loss) is below residual_tol * (1 + max |expectile|)
+    are cached, so a failed imputation is solved again next time instead of being served from the cache.
+    least recently used entries are dropped beyond max_entries, and the cache is kept on disk at path
+    (loaded when it exists, written by save and every save_every new entries)
+    :param tol: quantization step of the expectiles (and taus)
+    :param solver: fn(expectiles, taus) -> samples for a single set, used for every miss. default fit_samples
+        (infer_dist_batch with seeded restarts), whose misses infer_batch solves all at once with fit_samples_batch.
+        (infer_dist's scipy lm rarely gets below residual_tol, so most of its solutions would not be cached)
+    :param solver_name: saved with the cache, and a cache saved under another name is not loaded. default is the
+        solver's __name__; lambdas and partials have no name of their own and need one
+    """
+    def __init__(self, path=None, tol=1e-6, max_entries=100000, save_every=1000, solver=None, solver_name=None,
+                 residual_tol=1e-8):
+        self.path = path
+        self.tol = tol
+        self.max_entries = max_entries
+        self.save_every = save_every
+        self.solver = fit_samples if solver is None else solver
+        self.solver_name = getattr(self.solver, '__name__', None) if solver_name is None else solver_name
+        assert self.solver_name not in (None, '<lambda>'), 'give the solver a solver_name'
+        self.residual_tol = residual_tol
+        self.entries = OrderedDict()
+        self.hits = self.misses = self.failures = self.unsaved = 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def key(self, expectiles, taus):
+        quantized = np.round(np.hstack([expectiles, taus]) / self.tol).astype(np.int64)
+        return (len(expectiles), quantized.tobytes())
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, samples):
+        self.entries[key] = samples
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.unsaved += 1
+        if self.path is not None and self.unsaved >= self.save_every:
+            self.save()
+
+    def store(self, key, expectiles, taus, samples):
+        # caches a solved miss only if it converged
+        residual = np.max(np.abs(expectile_grad_loss(expectiles, taus, samples)))
+        if residual <= self.residual_tol * (1 + np.max(np.abs(expectiles))):
+            self.put(key, samples)
+        else:
+            self.failures += 1
+        return samples
+
+    def solve(self, key, expectiles, taus):
+        samples = np.asarray(self.solver(expectiles.copy(), taus.copy()), dtype=float)
+        return self.store(key, expectiles, taus, samples)
+
+    def __call__(self, expectiles, taus):
+        """ cached solver(expectiles, taus) """
+        expectiles, taus = np.asarray(expectiles, dtype=float), np.asarray(taus, dtype=float)
+        key = self.key(expectiles, taus)
+        samples = self.get(key)
+        if samples is None:
+            samples = self.solve(key, expectiles, taus)
+        return samples.copy()
+
+    def infer_batch(self, expectiles, taus):
+        """
+        cached imputation of num_sets x num_expectiles expectiles: the misses are solved once per distinct key
+        """
+        expectiles = np.atleast_2d(np.asarray(expectiles, dtype=float))
+        taus = np.broadcast_to(np.asarray(taus, dtype=float), expectiles.shape)
+        samples = np.zeros(expectiles.shape)
+        keys = [self.key(e, t) for (e, t) in zip(expectiles, taus)]
+        misses = OrderedDict()  # key -> rows, in order of first appearance
+        for (i, key) in enumerate(keys):
+            if key in misses:  # repeated within the batch, solved once (even if it was not cached)
+                self.hits += 1
+                misses[key].append(i)
+                continue
+            cached = self.get(key)
+            if cached is None:
+                misses[key] = [i]
+            else:
+                samples[i] = cached
+        first = np.array([rows[0] for rows in misses.values()], dtype=int)
+        if self.solver is fit_samples and len(first):
+            solved, _ = fit_samples_batch(expectiles[first], taus[first], verbose=False)
+            solved = [self.store(key, expectiles[i], taus[i], s) for (key, i, s) in zip(misses, first, solved)]
+        else:
+            solved = [self.solve(key, expectiles[i], taus[i]) for (key, i) in zip(misses, first)]
+        for (rows, solved_i) in zip(misses.values(), solved):
+            samples[rows] = solved_i
+        return samples
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def report(self):
+        print('{:d} hits, {:d} misses ({:.1%} hit rate), {:d} not converged (not cached), {:d} entries'.format(
+            self.hits, self.misses, self.hit_rate, self.failures, len(self.entries)))
+
+    def save(self, path=None):
+        # write to a temporary name first, so a half-written cache is never loaded
+        path = self.path if path is None else path
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump({'tol': self.tol, 'solver': self.solver_name, 'entries': self.entries}, f)
+        os.replace(path + '.tmp', path)
+        self.unsaved = 0
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+        assert saved['tol'] == self.tol, 'cache was saved with another tol'
+        assert saved.get('solver') == self.solver_name, 'cache was saved with another solver'
+        self.entries = saved['entries']
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return self
+
+
+########## DISTRIBUTIONAL TD ###########
+
+# Figure 7 Part 1 trains the value heads w (num_dists x num_feats + 1) on the monte-carlo return of each trial,
+# stepping backwards through the trial. train_dist_td runs the same updates with the per-episode parts
+# (targets, normalization, bias column) computed once per episode, and with the rows of every
+# (num_dists, k) configuration stacked into one w, so each step is one matrix-vector product and one
+# rank-1 update for all configurations.
+
+DIST_TD_MODES = ('expectile', 'quantile')
+
+
+def get_taus(num_dists):
+    # taus of Figure 7 (not including the boundaries, matching lowet et al)
+    return (2 * np.arange(1, num_dists + 1) - 1) / num_dists / 2
+
+
+def train_dist_td(feats_, ep_rewards, configs, gamma=0.99, mode='expectile', w_init=None, return_pes=False):
+    """
+    trains value heads with asymmetric TD-1 updates, as Figure 7 Part 1: at every step t (last to first)
+        pe = R * gamma ** (L - t - 1) - w x_t,  w <- w + outer(alpha * update(pe) / (f_t . f_t), x_t)
+    with x_t = [f_t, 1], alpha = alpha_minus where pe <= 0 and alpha_plus otherwise (from get_alphas),
+    and update(pe) = pe for expectiles or sign(pe) for quantiles
+    :param feats_: list of num_timesteps x num_feats features per episode (e.g. z-scored, up to the reward)
+    :param ep_rewards: total reward R of each episode
+    :param configs: list of (num_dists or taus, k) pairs, trained side by side on the same steps.
+        a single (num_dists or taus, k) pair gives a single result
+    :param mode: 'expectile' or 'quantile'
+    :param w_init: starting weights per config. default is zeros
+    :param return_pes: also return the pes and values (num_timesteps x num_dists per episode) during training
+    :return: w per config (and pes_, vs_ per config)
+    """
+    assert mode in DIST_TD_MODES
+    single = len(configs) == 2 and np.isscalar(configs[1])  # one (num_dists or taus, k) pair
+    configs = [configs] if single else configs
+    taus_ = [get_taus(dists) if np.ndim(dists) == 0 else np.asarray(dists, dtype=float) for (dists, _) in configs]
+    alphas = [get_alphas(taus, k) for (taus, (_, k)) in zip(taus_, configs)]
+    alpha_plus, alpha_minus = np.hstack([a[0] for a in alphas]), np.hstack([a[1] for a in alphas])
+    splits = np.cumsum([len(taus) for taus in taus_])[:-1]
+
+    num_feats = feats_[0].shape[1]
+    w = np.zeros((len(alpha_plus), num_feats + 1), order='F')  # fortran order for in-place blas updates
+    if w_init is not None:
+        w[:] = np.vstack([w_init] if single else w_init)
+    pes_, vs_ = [], []
+    for (feats, reward) in zip(feats_, ep_rewards):
+        ep_len = len(feats)
+        x = np.hstack([feats, np.ones((ep_len, 1))])
+        targets = reward * gamma ** (ep_len - np.arange(ep_len) - 1)
+        norm_factors = 1 / np.einsum('tf,tf->t', feats, feats)
+        pes_tr, vs_tr = np.zeros((ep_len, len(w))), np.zeros((ep_len, len(w)))
+        for ts in np.arange(ep_len)[::-1]:
+            V = vs_tr[ts]
+            np.dot(w, x[ts], out=V)
+            pe = pes_tr[ts]
+            np.subtract(targets[ts], V, out=pe)
+            gains = np.where(pe <= 0, alpha_minus, alpha_plus)
+            gains *= norm_factors[ts] * (pe if mode == 'expectile' else np.sign(pe))
+            w = blas.dger(1., gains, x[ts], a=w, overwrite_a=1)
+        pes_.append(pes_tr)
+        vs_.append(vs_tr)
+
+    ws = np.split(np.ascontiguousarray(w), splits)
+    if return_pes:
+        pes_ = [list(c) for c in zip(*[np.split(pes_tr, splits, 1) for pes_tr in pes_])] or [[] for _ in ws]
+        vs_ = [list(c) for c in zip(*[np.split(vs_tr, splits, 1) for vs_tr in vs_])] or [[] for _ in ws]
+        return (ws[0], pes_[0], vs_[0]) if single else (ws, pes_, vs_)
+    return ws[0] if single else ws
+
+
 ########## TESTS ###########
 """
 plot_all_PEs plots PEs for each dist unit
@@ -0,0 +1,155 @@
+import numpy as np
+import multiprocessing as mp
+from functools import partial
+
+
+#### PERMUTATION / BOOTSTRAP TESTS FOR D'
+# d' and mean differences of all units for many label shuffles (or bootstrap resamples) at once.
+# Every resample is a row of weights over the trials (how often each trial counts for group a and for
+# group b), so the group sums of all units for a whole chunk of resamples are two matrix products.
+# Resamples are drawn chunk_size at a time from RandomState([seed, chunk]), so the results do not depend
+# on the chunk order or on how many worker processes were used.
+
+STATS = ('d_prime', 'mean_diff')
+
+
+def weighted_stats(weights_a, weights_b, x):
+    """
+    d' and mean difference (group a - group b) of every unit for every row of weights
+    input: weights_a, weights_b: num_resamples x num_trials (e.g. 0/1 labels or bootstrap counts)
+           x: num_trials x num_units responses (centered by the caller for precision)
+    output: d_prime, mean_diff: num_resamples x num_units. the std is ddof = 0, as in get_d_prime
+    """
+    def mean_var(weights):
+        n = np.sum(weights, 1, keepdims = True)
+        mean = weights @ x / n
+        return mean, weights @ (x ** 2) / n - mean ** 2
+    (mean_a, var_a), (mean_b, var_b) = mean_var(weights_a), mean_var(weights_b)
+    mean_diff = mean_a - mean_b
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        d_prime = mean_diff / np.sqrt(0.5 * np.maximum(var_a + var_b, 0))
+    return d_prime, mean_diff
+
+
+def get_d_prime_stats(x_a, x_b):
+    """
+    d' (same as get_d_prime(x_a, x_b)) and mean difference of every unit
+    input: x_a, x_b: num_trials in a x num_units, num_trials in b x num_units
+    """
+    x = np.vstack((x_a, x_b)).astype(float)
+    labels = np.arange(len(x)) < len(x_a)
+    d_prime, mean_diff = weighted_stats(labels[None, :].astype(float), ~labels[None, :], x - np.mean(x, 0))
+    return d_prime[0], mean_diff[0]
+
+
+def _permutation_chunk(chunk, x, num_a, num_perms, chunk_size, seed, observed):
+    # number of shuffles at least as extreme (two-sided) as the observed statistics, per unit
+    rng = np.random.RandomState([seed, chunk])
+    num_chunk = min(chunk_size, num_perms - chunk * chunk_size)
+    ranks = np.argsort(rng.random_sample((num_chunk, len(x))), 1)
+    labels = (ranks < num_a).astype(float)
+    null = weighted_stats(labels, 1 - labels, x)
+    return [np.sum(np.abs(null_s) >= np.abs(obs_s) - 1e-12, 0) for (null_s, obs_s) in zip(null, observed)]
+
+
+def _bootstrap_chunk(chunk, x, num_a, num_boots, chunk_size, seed):
+    # d' and mean difference for resamples (with replacement, within each group) of the trials
+    rng = np.random.RandomState([seed, chunk])
+    num_chunk = min(chunk_size, num_boots - chunk * chunk_size)
+    num_b = len(x) - num_a
+    def counts(n, offset): # how often each trial was drawn, one row per resample
+        flat_idx = np.arange(num_chunk)[:, None] * len(x) + offset + rng.randint(n, size = (num_chunk, n))
+        return np.bincount(flat_idx.ravel(), minlength = num_chunk * len(x)).reshape(num_chunk, len(x)).astype(float)
+    return weighted_stats(counts(num_a, 0), counts(num_b, num_a), x)
+
+
+def _map_chunks(chunk_fn, num_chunks, num_workers):
+    if num_workers is None or num_workers <= 1:
+        return [chunk_fn(chunk) for chunk in np.arange(num_chunks)]
+    with mp.Pool(processes = num_workers) as pool:
+        return pool.map(chunk_fn, np.arange(num_chunks))
+
+
+def permutation_test(x_a, x_b, num_perms = 10000, chunk_size = 1000, num_workers = None, seed = 0, alpha = 0.05):
+    """
+    shuffles the group labels num_perms times to get a null distribution for d' and the mean difference
+    of every unit, with two-sided p-values and Holm-Bonferroni correction over units
+    input: x_a, x_b: num_trials in a x num_units, num_trials in b x num_units
+           chunk_size: shuffles evaluated at once (memory is about chunk_size x num_trials)
+           num_workers: spread the chunks over this many processes. default is to not use a pool
+    output: dict with, for 'd_prime' and 'mean_diff', the observed statistic and then
+            '<stat>_pvals' (1 + number at least as extreme) / (1 + num_perms),
+            '<stat>_adj_pvals' and '<stat>_pcrit' from find_holmbonferroni
+    """
+    x = np.vstack((x_a, x_b)).astype(float)
+    x = x - np.mean(x, 0)
+    observed = get_d_prime_stats(x_a, x_b)
+
+    num_chunks = int(np.ceil(num_perms / chunk_size))
+    chunk_fn = partial(_permutation_chunk, x = x, num_a = len(x_a), num_perms = num_perms,
+                       chunk_size = chunk_size, seed = seed, observed = observed)
+    exceed = np.sum(np.array(_map_chunks(chunk_fn, num_chunks, num_workers)), 0)
+
+    results = {}
+    for (stat, obs_s, exceed_s) in zip(STATS, observed, exceed):
+        pvals = (1 + exceed_s) / (1 + num_perms)
+        pcrit, adj_pvals = find_holmbonferroni(pvals, alpha)
+        results.update({stat: obs_s, stat + '_pvals': pvals, stat + '_adj_pvals': adj_pvals, stat + '_pcrit': pcrit})
+    return results
+
+
+def bootstrap_test(x_a, x_b, num_boots = 10000, chunk_size = 1000, num_workers = None, seed = 0, alpha = 0.05,
+                   ci = 95, return_samples = False):
+    """
+    resamples the trials of each group with replacement num_boots times, for confidence intervals of
+    d' and the mean difference of every unit and two-sided p-values for them being 0 (Holm-Bonferroni corrected)
+    output: dict with, for 'd_prime' and 'mean_diff', the observed statistic, '<stat>_ci' (2 x num_units),
+            '<stat>_pvals', '<stat>_adj_pvals', '<stat>_pcrit', and with return_samples '<stat>_samples'
+    """
+    x = np.vstack((x_a, x_b)).astype(float)
+    x = x - np.mean(x, 0)
+    observed = get_d_prime_stats(x_a, x_b)
+
+    num_chunks = int(np.ceil(num_boots / chunk_size))
+    chunk_fn = partial(_bootstrap_chunk, x = x, num_a = len(x_a), num_boots = num_boots,
+                       chunk_size = chunk_size, seed = seed)
+    chunks = _map_chunks(chunk_fn, num_chunks, num_workers)
+
+    results = {}
+    for (s, stat) in enumerate(STATS):
+        samples = np.vstack([chunk[s] for chunk in chunks])
+        pvals = np.minimum(1, 2 * np.minimum(np.mean(samples <= 0, 0), np.mean(samples >= 0, 0)))
+        pcrit, adj_pvals = find_holmbonferroni(pvals, alpha)
+        results.update({stat: observed[s], stat + '_pvals': pvals, stat + '_adj_pvals': adj_pvals, stat + '_pcrit': pcrit,
+                        stat + '_ci': np.nanpercentile(samples, [(100 - ci) / 2, 100 - (100 - ci) / 2], axis = 0)})
+        if return_samples:
+            results[stat + '_samples'] = samples
+    return results
+
+
+def find_holmbonferroni(pvals_vec, alpha = 0.05):
+    """
+    Holm-Bonferroni correction, as find_holmbonferroni.m: order all pvals p(1) ... p(m), find the minimal k
+    such that p(k) > alpha / (m + 1 - k), reject 1 : k - 1 and not k : m
+    output: pcrit: threshold below which the pvalues are significant (2 if all are, -1 if none are)
+            adj_pvals: the pvalues adjusted by the multiple comparisons test
+    """
+    pvals_vec = np.ravel(pvals_vec)
+    m = len(pvals_vec)
+    sortinds = np.argsort(pvals_vec, kind = 'stable')
+    psorted = pvals_vec[sortinds]
+    testvec = alpha / (m + 1 - np.arange(1, m + 1))
+
+    crit = np.flatnonzero(psorted > testvec)
+    if len(crit) == 0:
+        pcrit = 2
+    elif crit[0] == 0:
+        pcrit = -1
+    else:
+        pcrit = np.mean(psorted[crit[0] - 1:crit[0] + 1])
+
+    # fmin/fmax skip nans like MATLAB's min and max (sort puts nans last in both)
+    adjvec = np.fmin((m - np.arange(1, m + 1) + 1) * psorted, 1)
+    adj_pvals = np.zeros(m)
+    adj_pvals[sortinds] = np.fmax.accumulate(adjvec)
+    return pcrit, adj_pvals
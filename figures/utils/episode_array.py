@@ -0,0 +1,146 @@
+import numpy as np
+
+
+class EpisodeArray(object):
+    """
+    episodes of different lengths stored CSR-style: one flat array with all timesteps of all
+    episodes stacked (num_timesteps_total x ...) plus offsets, where episode i is
+    data[offsets[i]:offsets[i + 1]].
+    indexing with an int gives a view of one episode, so code written for lists of per-episode
+    arrays (feats_, pes_, ypos_, tow_counts_, ...) keeps working on it.
+    """
+    def __init__(self, data, offsets):
+        self.data = np.asarray(data)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        assert self.offsets[0] == 0 and self.offsets[-1] == len(self.data), 'offsets must span the data'
+
+    @classmethod
+    def from_list(cls, episodes_):
+        """ builds it from a list of per-episode arrays """
+        lengths = [len(ep) for ep in episodes_]
+        return cls(np.concatenate([np.asarray(ep) for ep in episodes_]), np.concatenate([[0], np.cumsum(lengths)]))
+
+    @classmethod
+    def from_lengths(cls, data, episode_lengths):
+        """ wraps an already stacked array (e.g. np.vstack(feats_)) without copying it """
+        return cls(data, np.concatenate([[0], np.cumsum(episode_lengths)]).astype(np.int64))
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """ loads what save wrote. with mmap_mode = 'r' the data stays on disk until it is used """
+        return cls(np.load(path + '_data.npy', mmap_mode=mmap_mode), np.load(path + '_offsets.npy'))
+
+    def save(self, path):
+        """ saves to <path>_data.npy and <path>_offsets.npy (uncompressed so load can memory-map) """
+        np.save(path + '_data.npy', self.data)
+        np.save(path + '_offsets.npy', self.offsets)
+
+    @property
+    def episode_lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def episode_idx(self):
+        """ episode of every timestep of data """
+        return np.repeat(np.arange(len(self)), self.episode_lengths)
+
+    @property
+    def shape(self):
+        return (len(self), None) + self.data.shape[1:]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            idx = idx + len(self) if idx < 0 else idx
+            return self.data[self.offsets[idx]:self.offsets[idx + 1]]
+        if isinstance(idx, slice) and idx.step in (None, 1):
+            start, stop, _ = idx.indices(len(self))
+            stop = max(start, stop)
+            return EpisodeArray(self.data[self.offsets[start]:self.offsets[stop]], self.offsets[start:stop + 1] - self.offsets[start])
+        # any other selection of episodes (index array, boolean mask, strided slice) copies them
+        episodes = np.arange(len(self))[idx]
+        lengths = self.episode_lengths[episodes]
+        return EpisodeArray.from_lengths(self.data[np.repeat(self.offsets[episodes], lengths) + _ranges(lengths)], lengths)
+
+    def __iter__(self):
+        for i in np.arange(len(self)):
+            yield self[i]
+
+    def to_list(self):
+        return [self[i] for i in np.arange(len(self))]
+
+    def map(self, fn):
+        """ applies a timestep-wise function (e.g. lambda x: x @ w) to all episodes at once """
+        return EpisodeArray(fn(self.data), self.offsets)
+
+    #### PER-EPISODE REDUCTIONS
+    # one ufunc.reduceat over the flat data; empty episodes give nan
+
+    def reduce(self, ufunc):
+        lengths = self.episode_lengths
+        out = np.full((len(self),) + self.data.shape[1:], np.nan)
+        if np.any(lengths > 0):
+            out[lengths > 0] = ufunc.reduceat(self.data, self.offsets[:-1][lengths > 0], axis=0)
+        return out
+
+    def sum(self):
+        return self.reduce(np.add)
+
+    def mean(self):
+        lengths = self.episode_lengths.reshape((-1,) + (1,) * (self.data.ndim - 1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum() / lengths
+
+    def max(self):
+        return self.reduce(np.maximum)
+
+    def min(self):
+        return self.reduce(np.minimum)
+
+    def take(self, steps):
+        """
+        one timestep per episode, e.g. ep_rewidx. negative steps count from the end of the episode
+        output: num_episodes x ... array, nan where the step is outside the episode
+        """
+        return self.windows(steps, 0, 1)[:, 0]
+
+    def windows(self, centers, before, after):
+        """
+        fixed-length window around one timestep per episode, e.g. pes_i[rew_idx - 5:rew_idx + 6]
+        inputs: centers: timestep per episode (negative counts from the end of the episode)
+                before, after: window is [center - before, center + after)
+        output: num_episodes x (before + after) x ... array, nan where the window leaves the episode
+        """
+        lengths = self.episode_lengths
+        centers = np.broadcast_to(centers, (len(self),)).astype(np.int64)
+        centers = np.where(centers < 0, centers + lengths, centers)
+        steps = centers[:, None] + np.arange(-before, after)[None, :]
+        valid = (steps >= 0) & (steps < lengths[:, None])
+        flat_idx = np.where(valid, self.offsets[:-1, None] + steps, 0)
+        out = self.data[flat_idx].astype(float) if len(self.data) else np.zeros(flat_idx.shape + self.data.shape[1:])
+        out[~valid] = np.nan
+        return out
+
+    def head(self, num_steps):
+        """ the first num_steps of every episode (all of it for shorter episodes), e.g. the cue period """
+        lengths = np.minimum(self.episode_lengths, num_steps)
+        return EpisodeArray.from_lengths(self.data[np.repeat(self.offsets[:-1], lengths) + _ranges(lengths)], lengths)
+
+
+def _ranges(lengths):
+    # concatenation of np.arange(l) for every l in lengths
+    lengths = np.asarray(lengths, dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    return np.arange(np.sum(lengths)) - np.repeat(starts, lengths)
+
+
+def as_flat(episodes_):
+    """
+    flat data and episode lengths of either an EpisodeArray (no copy) or a list of per-episode arrays
+    """
+    if isinstance(episodes_, EpisodeArray):
+        return episodes_.data, episodes_.episode_lengths
+    episodes_ = [np.asarray(ep) for ep in episodes_]
+    return np.concatenate(episodes_), np.array([len(ep) for ep in episodes_])
@@ -0,0 +1,181 @@
+import numpy as np
+import os
+
+from .episode_array import EpisodeArray
+
+
+#### PER-FEATURE NORMALIZATION
+# The figure notebooks z-score all features with zscore(np.vstack(feats_), 0) and split them back into
+# episodes. Here the per-feature statistics are computed in one streaming pass over the episodes,
+# saved next to the dataset they came from, and episodes are only normalized when they are asked for.
+
+STATS_SUFFIX = '_featstats.npz'
+NORM_METHODS = ('zscore', 'minmax', 'robust')
+
+
+class FeatureStats(object):
+    """
+    running per-feature count, mean and variance (merged chunk by chunk), min and max, plus a uniform
+    reservoir sample of datapoints for quantiles
+    reservoir_size: number of datapoints kept for the quantiles (they are exact if there are fewer datapoints)
+    """
+    def __init__(self, reservoir_size = 20000, seed = 0):
+        self.reservoir_size = reservoir_size
+        self.rng = np.random.RandomState(seed)
+        self.n = 0
+        self.mean = self.M2 = self.min = self.max = self.reservoir = None
+
+    def update(self, chunk):
+        """ adds a (datapoints x features) chunk """
+        chunk = np.asarray(chunk, dtype = float).reshape(len(chunk), -1)
+        n_chunk = len(chunk)
+        if n_chunk == 0:
+            return self
+        if self.n == 0:
+            self.mean, self.M2 = np.zeros(chunk.shape[1]), np.zeros(chunk.shape[1])
+            self.min, self.max = np.min(chunk, 0), np.max(chunk, 0)
+            self.reservoir = np.zeros((0, chunk.shape[1]))
+
+        mean_chunk = np.mean(chunk, 0)
+        delta = mean_chunk - self.mean
+        self.M2 = self.M2 + np.sum((chunk - mean_chunk) ** 2, 0) + delta ** 2 * self.n * n_chunk / (self.n + n_chunk)
+        self.mean = self.mean + delta * n_chunk / (self.n + n_chunk)
+        self.min, self.max = np.minimum(self.min, np.min(chunk, 0)), np.maximum(self.max, np.max(chunk, 0))
+        self._sample(chunk)
+        self.n += n_chunk
+        return self
+
+    def _sample(self, chunk):
+        # reservoir sampling: the i-th datapoint overall replaces a random slot with probability size / (i + 1)
+        num_free = self.reservoir_size - len(self.reservoir)
+        self.reservoir = np.vstack([self.reservoir, chunk[:num_free]])
+        rest = chunk[num_free:] if num_free > 0 else chunk
+        if len(rest):
+            seen = self.n + len(chunk) - len(rest) + np.arange(len(rest))
+            slots = (self.rng.random_sample(len(rest)) * (seen + 1)).astype(int)
+            keep = slots < self.reservoir_size
+            self.reservoir[slots[keep]] = rest[keep]
+
+    @property
+    def std(self):
+        """ population std (ddof = 0), as scipy.stats.zscore uses """
+        return np.sqrt(self.M2 / self.n)
+
+    def quantile(self, q):
+        return np.quantile(self.reservoir, q, axis = 0)
+
+    def save(self, path, fingerprint = ()):
+        # the reservoir rng state is saved too, so updates after load sample as an uninterrupted run would
+        (_, rng_keys, rng_pos, rng_has_gauss, rng_gauss) = self.rng.get_state()
+        np.savez(path, n = self.n, mean = self.mean, M2 = self.M2, min = self.min, max = self.max,
+                 reservoir = self.reservoir, reservoir_size = self.reservoir_size, fingerprint = np.array(fingerprint),
+                 rng_keys = rng_keys, rng_pos = rng_pos, rng_has_gauss = rng_has_gauss, rng_gauss = rng_gauss)
+
+    @classmethod
+    def load(cls, path):
+        saved = np.load(path)
+        stats = cls(int(saved['reservoir_size']))
+        stats.n = int(saved['n'])
+        for field in ['mean', 'M2', 'min', 'max', 'reservoir']:
+            setattr(stats, field, saved[field])
+        if 'rng_keys' in saved.files:
+            stats.rng.set_state(('MT19937', saved['rng_keys'], int(saved['rng_pos']),
+                                 int(saved['rng_has_gauss']), float(saved['rng_gauss'])))
+        return stats
+
+
+def iter_chunks(feats_, chunk_size = 500):
+    # (datapoints x features) blocks of chunk_size consecutive episodes
+    for start in np.arange(0, len(feats_), chunk_size):
+        if isinstance(feats_, EpisodeArray):
+            yield feats_[start:start + chunk_size].data
+        else:
+            yield np.vstack(feats_[start:start + chunk_size])
+
+
+def compute_feature_stats(feats_, chunk_size = 500, reservoir_size = 20000, seed = 0):
+    """
+    per-feature statistics of a list (or EpisodeArray) of (num_timesteps x num_features) episodes, in one pass
+    """
+    stats = FeatureStats(reservoir_size, seed)
+    for chunk in iter_chunks(feats_, chunk_size):
+        stats.update(chunk)
+    return stats
+
+
+def get_fingerprint(feats_, reservoir_size = 20000):
+    # what the saved stats have to match: number of episodes, total timesteps, number of features, reservoir size.
+    # e.g. feats_torew_ (cut at the reward) and all of feats_ from the same pickle differ in total timesteps
+    lengths = feats_.episode_lengths if isinstance(feats_, EpisodeArray) else [len(ep) for ep in feats_]
+    num_feats = int(np.prod(np.shape(feats_[0])[1:])) if len(feats_) else 0
+    return (len(feats_), int(np.sum(lengths)), num_feats, reservoir_size)
+
+
+def get_feature_stats(feats_, dataset_path = None, name = None, **kwargs):
+    """
+    compute_feature_stats, saved to <dataset_path>_<name>_featstats.npz and reused while it is newer than the dataset
+    and was computed from episodes with the same get_fingerprint
+    dataset_path: the file feats_ was loaded from (e.g. a pickle of model data). default is to not save
+    name: what part of the dataset feats_ is (e.g. 'torew'). default is named by the fingerprint
+    """
+    if dataset_path is None:
+        return compute_feature_stats(feats_, **kwargs)
+    fingerprint = get_fingerprint(feats_, kwargs.get('reservoir_size', 20000))
+    name = 'x'.join(str(f) for f in fingerprint) if name is None else name
+    stats_path = dataset_path + '_' + name + STATS_SUFFIX
+    if os.path.exists(stats_path) and os.path.getmtime(stats_path) >= os.path.getmtime(dataset_path):
+        saved = np.load(stats_path)
+        saved_fingerprint = tuple(int(f) for f in saved['fingerprint']) if 'fingerprint' in saved.files else ()
+        if saved_fingerprint == fingerprint:
+            return FeatureStats.load(stats_path)
+        print('{} was computed from other episodes {}, recomputing'.format(stats_path, saved_fingerprint))
+    stats = compute_feature_stats(feats_, **kwargs)
+    stats.save(stats_path, fingerprint)
+    return stats
+
+
+class NormalizedEpisodes(object):
+    """
+    lazily normalized view of a list (or EpisodeArray) of episodes: episode i is only normalized when
+    it is indexed, so it can stand in for split_by_ep_len(zscore(np.vstack(feats_), 0), ...)
+    method: 'zscore' ((x - mean) / std), 'minmax' ((x - min) / (max - min)) or
+            'robust' ((x - median) / interquartile range, from the reservoir)
+    """
+    def __init__(self, feats_, stats, method = 'zscore'):
+        assert method in NORM_METHODS
+        (self.feats_, self.stats, self.method) = (feats_, stats, method)
+        if method == 'zscore':
+            (self.center, self.scale) = (stats.mean, stats.std)
+        elif method == 'minmax':
+            (self.center, self.scale) = (stats.min, stats.max - stats.min)
+        else:
+            (q25, q50, q75) = stats.quantile([0.25, 0.5, 0.75])
+            (self.center, self.scale) = (q50, q75 - q25)
+
+    def normalize(self, data):
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            return (data - self.center) / self.scale
+
+    def __len__(self):
+        return len(self.feats_)
+
+    def __getitem__(self, i):
+        if isinstance(i, (int, np.integer)):
+            return self.normalize(self.feats_[i])
+        if isinstance(self.feats_, EpisodeArray):
+            return NormalizedEpisodes(self.feats_[i], self.stats, self.method)
+        return NormalizedEpisodes([self.feats_[j] for j in np.arange(len(self))[i]], self.stats, self.method)
+
+    def __iter__(self):
+        for i in np.arange(len(self)):
+            yield self[i]
+
+    def window(self, i, start, stop):
+        """ normalized timesteps [start, stop) of episode i, without normalizing the rest of it """
+        return self.normalize(self.feats_[i][start:stop])
+
+    def windows(self, centers, before, after):
+        """ normalized EpisodeArray.windows (episodes x window x features, nan outside the episode).
+        a list of episodes is stacked into an EpisodeArray first """
+        feats_ = self.feats_ if isinstance(self.feats_, EpisodeArray) else EpisodeArray.from_list(self.feats_)
+        return self.normalize(feats_.windows(centers, before, after))
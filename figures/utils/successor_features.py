@@ -0,0 +1,124 @@
+import numpy as np
+import os
+from scipy.linalg import blas
+
+from .episode_array import EpisodeArray, as_flat
+
+
+#### SUCCESSOR FEATURES
+# Figure 6 learns successor feature weights W with TD on the (z-scored) LSTM features f_t:
+#     TD_phi_t = f_t + gamma * W f_{t+1} - W f_t,    W <- W + alpha * outer(TD_phi_t, f_t)
+# for every step but the last of each episode (TD_phi is 0 there), and then recomputes TD_phi
+# (the sensory PEs) of every episode with W frozen.
+
+
+def get_sf_td(w, feats_, gamma = 0.99):
+    """
+    TD_phi of every step with frozen weights, for all episodes at once:
+        TD_phi = F + gamma * F_next W^T - F W^T, 0 at the last step of each episode
+    input: w: num_feats x num_feats successor feature weights
+           feats_: list (or EpisodeArray) of num_timesteps x num_feats features per episode
+    output: TD_phi per episode, in the same form as feats_
+    """
+    feats, episode_lengths = as_flat(feats_)
+    feats = np.asarray(feats, dtype = float)
+    psi = feats @ w.T
+    td_phi = feats - psi
+    td_phi[:-1] += gamma * psi[1:]
+    td_phi[np.cumsum(episode_lengths)[episode_lengths > 0] - 1] = 0 # last step of each episode
+    if isinstance(feats_, EpisodeArray):
+        return EpisodeArray(td_phi, feats_.offsets)
+    return np.split(td_phi, np.cumsum(episode_lengths)[:-1])
+
+
+class SFTrainer(object):
+    """
+    trains the successor feature weights over episodes in order, either step by step exactly as in
+    Figure 6 (batch_size = None) or with one update per minibatch of batch_size episodes, whose TD errors
+    are all computed with the weights from before the minibatch and summed into the update.
+    the trainer is deterministic, and train can checkpoint and resume it with identical results.
+    """
+    def __init__(self, num_feats, gamma = 0.99, alpha = 0.001, batch_size = None):
+        self.gamma = gamma
+        self.alpha = alpha
+        self.batch_size = batch_size
+        self.w = np.zeros((num_feats, num_feats), order = 'F') # fortran order for in-place blas updates
+        self.num_episodes_trained = 0
+
+    def train_episode(self, feats):
+        """
+        one episode of step-by-step TD (the Figure 6 loop)
+        output: TD_phi (num_timesteps x num_feats) at each step, before that step's update
+        """
+        feats = np.ascontiguousarray(feats, dtype = float)
+        td_phi = np.zeros(feats.shape)
+        if len(feats) == 0:
+            return td_phi
+        # psi = W f_t is carried over: after the update, W f_{t+1} changes by alpha * TD_phi_t * (f_t . f_{t+1})
+        next_dots = np.einsum('tf,tf->t', feats[:-1], feats[1:])
+        psi = self.w @ feats[0]
+        for ts in np.arange(len(feats) - 1):
+            psi_next = self.w @ feats[ts + 1]
+            td = td_phi[ts]
+            np.multiply(psi_next, self.gamma, out = td)
+            td += feats[ts]
+            td -= psi
+            self.w = blas.dger(self.alpha, td, feats[ts], a = self.w, overwrite_a = 1)
+            psi = psi_next
+            psi += (self.alpha * next_dots[ts]) * td
+        self.num_episodes_trained += 1
+        return td_phi
+
+    def train_minibatch(self, feats_):
+        """
+        one update from a list of episodes, W <- W + alpha * sum_t outer(TD_phi_t, f_t)
+        output: TD_phi per episode, with the weights from before the update
+        """
+        td_phi_ = get_sf_td(self.w, feats_, self.gamma)
+        feats, _ = as_flat(feats_)
+        td_phi, _ = as_flat(td_phi_)
+        self.w += self.alpha * (td_phi.T @ np.asarray(feats, dtype = float))
+        self.num_episodes_trained += len(feats_)
+        return td_phi_
+
+    def train(self, feats_, checkpoint_path = None, checkpoint_every = 1000, return_td = False):
+        """
+        trains on feats_, starting after the episodes already trained on (e.g. after load)
+        input: feats_: list (or EpisodeArray) of num_timesteps x num_feats features per episode
+               checkpoint_path: if given, the trainer is resumed from it if it exists, and saved to it
+                                every checkpoint_every episodes and at the end
+               return_td: also return the TD_phi of the trained episodes (during training)
+        """
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            self.load(checkpoint_path)
+        td_phi_ = []
+        last_saved = self.num_episodes_trained
+        while self.num_episodes_trained < len(feats_):
+            start = self.num_episodes_trained
+            if self.batch_size is None:
+                td_phi_.append(self.train_episode(feats_[start]))
+            else:
+                batch = feats_[start:start + self.batch_size]
+                td_phi_ += list(self.train_minibatch(batch.to_list() if isinstance(batch, EpisodeArray) else batch))
+            if checkpoint_path is not None and self.num_episodes_trained - last_saved >= checkpoint_every:
+                self.save(checkpoint_path)
+                last_saved = self.num_episodes_trained
+        if checkpoint_path is not None:
+            self.save(checkpoint_path)
+        return (self.w, td_phi_) if return_td else self.w
+
+    def save(self, path):
+        # write to a temporary name first, so a half-written checkpoint is never loaded
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, w = self.w, num_episodes_trained = self.num_episodes_trained, gamma = self.gamma,
+                     alpha = self.alpha, batch_size = -1 if self.batch_size is None else self.batch_size)
+        os.replace(path + '.tmp', path)
+
+    def load(self, path):
+        saved = np.load(path)
+        assert saved['gamma'] == self.gamma and saved['alpha'] == self.alpha, 'checkpoint was trained with other parameters'
+        assert int(saved['batch_size']) == (-1 if self.batch_size is None else self.batch_size), \
+            'checkpoint was trained with another batch_size'
+        self.w = np.asfortranarray(saved['w'])
+        self.num_episodes_trained = int(saved['num_episodes_trained'])
+        return self